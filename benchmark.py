@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+"""
+Benchmark suite for the whole pipeline. Times each stage
+separately on the bundled genre/instrument corpora:
+parse_notes --> create_sequences --> one training epoch -->
+predict_note --> create_song --> write_to_midi
+and reports throughput and peak memory. Results are saved
+as JSON and can be compared against a previous run.
+
+Peak memory is the peak resident set size of the process, so it
+counts native allocations such as TensorFlow's as well as Python's.
+On Linux the peak is reset before each stage, so it is the stage's
+own peak; elsewhere it is the process's peak up to the end of the stage.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import getopt
+import resource
+import platform
+import tempfile
+import parse_midi as pm
+import generator as gen
+import song_creator as sc
+
+GENRES = ["johnnycash", "michaeljackson", "rock"]
+
+
+def __reset_peak_rss__():
+    """
+    resets the process's peak resident set size, on Linux.
+    Returns True if it could.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fw:
+            fw.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def __peak_rss__():
+    """
+    returns the peak resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def time_stage(function, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs) once and measures it. Measuring
+    the memory doesn't slow the function down.
+
+    returns: the function's result and a dict of the elapsed seconds,
+    the peak resident set size in bytes, and whether that peak is the
+    stage's own (see the module docstring)
+    """
+    own_peak = __reset_peak_rss__()
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    return result, {"seconds": seconds, "peak_rss_bytes": __peak_rss__(), "stage_peak": own_peak}
+
+
+def benchmark_corpus(path, predict_calls=100):
+    """
+    Benchmarks every stage of the pipeline on one genre/instrument folder.
+
+    path: the genre/instrument folder, e.g. "rock/bass"
+    predict_calls: number of predict_note calls the latency is averaged over
+    returns: a dict of stage name --> measurements
+    """
+    genre, instrument = path.split("/")
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        # parse every song, without the notes cache
+        _, stats = time_stage(pm.parse_notes, "{}/training_songs/*.mid".format(path), tmp,
+                              use_cache=False)
+        managers = {section: pm.NotesManager("{}/{}.corpus".format(tmp, section))
+                    for section in ("intro", "middle", "outro")}
+        num_notes = sum(len(m.note_codes) for m in managers.values())
+        stats["notes_per_sec"] = num_notes / stats["seconds"]
+        results["parse_notes"] = stats
+
+        # build the training windows of all three sections
+        def create_sequences():
+            return [m.create_sequences() for m in managers.values()]
+
+        _, stats = time_stage(create_sequences)
+        num_windows = sum(len(m.training_input) for m in managers.values())
+        stats["windows_per_sec"] = num_windows / stats["seconds"]
+        results["create_sequences"] = stats
+
+        creator = sc.SongCreator(genre, instrument, parsed=True, epochs=1, managers=managers)
+
+        # one epoch over the middle section, the largest
+        middle = creator.middleRNN
+        _, stats = time_stage(middle.train, creator.middle_training_input,
+                              creator.middle_training_output)
+        stats["windows_per_sec"] = len(creator.middle_training_input) / stats["seconds"]
+        results["train_epoch"] = stats
+
+        # latency of a single note, after a warm up call
+        window = creator.middle_training_input[:1]
+        middle.predict_note(window)
+
+        def predict_notes():
+            for _ in range(predict_calls):
+                middle.predict_note(window)
+
+        _, stats = time_stage(predict_notes)
+        stats["seconds_per_note"] = stats["seconds"] / predict_calls
+        stats["notes_per_sec"] = predict_calls / stats["seconds"]
+        results["predict_note"] = stats
+
+        # a whole song with the default structure
+        song_notes = 32 + 52 + 64 + 52 + 64 + 48 + 64 + 32
+        _, stats = time_stage(creator.create_song, "benchmark.mid", folder=tmp)
+        stats["notes_per_sec"] = song_notes / stats["seconds"]
+        results["create_song"] = stats
+
+        # write the middle section's notes with both writers
+        notes = managers["middle"].decode(managers["middle"].note_codes)
+        for backend in ("music21", "mido"):
+            _, stats = time_stage(gen.write_to_midi, notes, "{}/benchmark.mid".format(tmp),
+                                  backend=backend)
+            stats["notes_per_sec"] = len(notes) / stats["seconds"]
+            results["write_to_midi_{}".format(backend)] = stats
+
+    return results
+
+
+def compare(results, baseline, threshold=.1):
+    """
+    Prints the time of every stage against a baseline run and
+    flags stages that got slower by more than the threshold.
+
+    results: the results of this run
+    baseline: the results of a previous run
+    threshold: fraction of slowdown reported as a regression
+    returns: the number of regressions
+    """
+    regressions = 0
+
+    for corpus, stages in sorted(results["corpora"].items()):
+        for stage, stats in stages.items():
+
+            previous = baseline.get("corpora", {}).get(corpus, {}).get(stage)
+            if not previous:
+                continue
+
+            ratio = stats["seconds"] / previous["seconds"]
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+
+            print("{:<24} {:<24} {:>9.4f}s -> {:>9.4f}s  x{:.2f}{}".format(
+                corpus, stage, previous["seconds"], stats["seconds"], ratio, flag))
+
+    return regressions
+
+
+def main(argv):
+
+    helpstring = ("benchmark.py -o <results.json> -b <baseline.json> -m <genres> -i <instruments>\n"
+                  "-o: file to save the results to as JSON\n"
+                  "-b: results of a previous run to compare against\n"
+                  "-m: comma separated genres to benchmark, johnnycash,michaeljackson,rock by default\n"
+                  "-i: comma separated instruments to benchmark, every instrument by default")
+
+    output = None
+    baseline = None
+    genres = GENRES
+    instruments = None
+
+    try:
+        opts, args = getopt.getopt(argv, "ho:b:m:i:", ["output=", "baseline=", "music=", "instrument="])
+    except getopt.GetoptError:
+        print(helpstring)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(helpstring)
+            sys.exit()
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-b", "--baseline"):
+            baseline = arg
+        elif opt in ("-m", "--music"):
+            genres = arg.split(",")
+        elif opt in ("-i", "--instrument"):
+            instruments = arg.split(",")
+
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "corpora": {},
+    }
+
+    for genre in genres:
+        for folder in sorted(glob.glob("{}/*/training_songs".format(genre))):
+
+            path = folder.rsplit("/", 1)[0]
+            if instruments and path.split("/")[1] not in instruments:
+                continue
+
+            print("benchmarking {}".format(path))
+            results["corpora"][path] = benchmark_corpus(path)
+
+            for stage, stats in results["corpora"][path].items():
+                print("  {:<24} {:>9.4f}s {:>9.1f}MB".format(stage, stats["seconds"],
+                                                             stats["peak_rss_bytes"] / 2 ** 20))
+
+    if output:
+        with open(output, "w") as fw:
+            json.dump(results, fw, indent=2)
+
+    if baseline:
+        with open(baseline) as fp:
+            if compare(results, json.load(fp)):
+                sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
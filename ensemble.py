@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+"""
+Ensemble jobs: trains, or generates songs for, every instrument
+of a genre (or of every genre) at once. Each genre/instrument is
+a job run in its own worker process, and the CPU threads are split
+between the jobs running together so they don't fight over cores.
+
+Generated songs are written per instrument under
+genre/instrument/nn_songs, or merged into one multi-track MIDI
+file per song under genre/nn_songs.
+"""
+
+import os
+import glob
+import multiprocessing
+import helpers
+import metrics
+import generator as gen
+from concurrent.futures import ProcessPoolExecutor
+
+
+def find_jobs(genres=None):
+    """
+    returns the (genre, instrument) pairs that have parsed notes
+
+    genres: a list of genres, every genre if None
+    """
+    jobs = []
+    for folder in sorted(glob.glob("*/*/parsed_notes")):
+        genre, instrument = folder.split("/")[:2]
+        if genres is None or genre in genres:
+            jobs.append((genre, instrument))
+    return jobs
+
+
+def __train_job__(genre, instrument, epochs, architecture, save, streaming, key_shift, patience, resume, dedup):
+    """
+    Trains the networks of one genre/instrument in a worker process
+    """
+    import song_creator as sc
+
+    song_creator = sc.SongCreator(genre, instrument, parsed=True, epochs=epochs, architecture=architecture)
+    song_creator.train(streaming=streaming, key_shift=key_shift, patience=patience, resume=resume, dedup=dedup)
+
+    if save:
+        song_creator.save_model()
+
+    return genre, instrument
+
+
+def __generate_job__(genre, instrument, num_songs, options, load, architecture):
+    """
+    Generates the notes of num_songs songs for one genre/instrument
+    in a worker process
+
+    options: the section lengths, seed, and sampling, as in SongCreator.generate_songs
+    architecture: the architecture the networks were trained with, to load their weights onto
+    """
+    import song_creator as sc
+
+    song_creator = sc.SongCreator(genre, instrument, parsed=True, architecture=architecture)
+    if load:
+        song_creator.load_nn()
+    else:
+        song_creator.load_nn_weights()
+
+    songs = song_creator.generate_songs(num_songs, **options)
+
+    # plain strings pickle smaller than numpy's
+    return genre, instrument, [[(str(pitch), str(duration)) for pitch, duration in song] for song in songs]
+
+
+def __init_worker__(threads, record_metrics):
+    """
+    Sets up a worker process: limits its threads, and records
+    metrics if this process does
+    """
+    helpers.limit_threads(threads)
+    if record_metrics:
+        metrics.enable()
+
+
+def __measured_job__(function, *job):
+    """
+    Runs function(*job) in a worker process
+
+    returns: its result and the metrics recorded while it ran
+    """
+    metrics.reset()
+    result = function(*job)
+    return result, metrics.snapshot()
+
+
+def __run_jobs__(function, jobs, workers, threads):
+    """
+    Runs function(*job) for every job on a pool of worker processes.
+    If metrics are being recorded, the workers record them too and
+    they are merged into this process's.
+
+    returns: the results of the jobs, in the order the jobs were given
+    """
+    workers = max(1, min(workers, len(jobs)))
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+
+    # spawned workers don't inherit an already initialized tensorflow
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=__init_worker__,
+                             initargs=(threads, metrics.enabled)) as executor:
+        futures = [executor.submit(__measured_job__, function, *job) for job in jobs]
+
+        results = []
+        for future in futures:
+            result, recorded = future.result()
+            metrics.merge(recorded)
+            results.append(result)
+
+        return results
+
+
+def train(genres=None, epochs=100, save=False, streaming=False, key_shift=0, patience=None, resume=False,
+          workers=None, threads=None, architecture="multi_hot", dedup=False):
+    """
+    Trains every instrument of the given genres
+
+    genres: a list of genres, every genre if None
+    epochs: an int, number of epochs to run during training
+    save: a Bool, set to True to save the model bundles
+    streaming, key_shift, patience, resume, dedup: as in SongCreator.train
+    workers: number of jobs to run at once, all of them by default
+    threads: number of CPU threads each job may use, the CPU count
+    split evenly between the workers by default
+    architecture: "multi_hot" or "embedding", see MusicRNN
+    returns: the (genre, instrument) pairs trained
+    """
+    jobs = find_jobs(genres)
+    return __run_jobs__(__train_job__, [job + (epochs, architecture, save, streaming, key_shift, patience, resume,
+                                               dedup) for job in jobs], workers or len(jobs), threads)
+
+
+def generate(song_name, genres=None, num_songs=1, merge=False, load=False, workers=None, threads=None,
+             seed=None, temperature=None, top_k=None, architecture="multi_hot", **lengths):
+    """
+    Generates songs for every instrument of the given genres. Every
+    instrument's song has the same structure and section lengths
+    (in notes), as in SongCreator.create_song.
+
+    song_name: A string, name of the files to save the songs as. With
+    num_songs > 1 they are saved as <song_name>_1.mid ... <song_name>_n.mid
+    genres: a list of genres, every genre if None
+    num_songs: an int, the number of songs per instrument
+    merge: a Bool, set to True to write every instrument of a song to
+    one multi-track MIDI file under genre/nn_songs instead of a file
+    per instrument under genre/instrument/nn_songs
+    load: a Bool, set to True to load the saved models instead of the weights
+    workers, threads: as in train
+    seed, temperature, top_k: as in SongCreator.generate_songs; every
+    instrument is generated from the same seed
+    architecture: "multi_hot" or "embedding", the architecture the networks
+    were trained with. Saved bundles (load) keep their own.
+    lengths: section lengths, see SongCreator.create_song
+    returns: the paths of the written files
+    """
+    if num_songs == 1:
+        song_names = [song_name + ".mid"]
+    else:
+        song_names = ["{}_{}.mid".format(song_name, i + 1) for i in range(num_songs)]
+
+    jobs = find_jobs(genres)
+    options = dict(lengths, seed=seed, temperature=temperature, top_k=top_k)
+    results = __run_jobs__(__generate_job__, [job + (num_songs, options, load, architecture) for job in jobs],
+                           workers or len(jobs), threads)
+
+    written = []
+
+    if merge:
+        tracks = {}  # genre --> list of (instrument, songs)
+        for genre, instrument, songs in results:
+            tracks.setdefault(genre, []).append((instrument, songs))
+
+        for genre, instrument_songs in tracks.items():
+            os.makedirs("{}/nn_songs".format(genre), exist_ok=True)
+            for i, name in enumerate(song_names):
+                filename = "{}/nn_songs/{}".format(genre, name)
+                gen.write_tracks_mido([(instrument, songs[i]) for instrument, songs in instrument_songs], filename)
+                written.append(filename)
+
+    else:
+        for genre, instrument, songs in results:
+            for name, notes in zip(song_names, songs):
+                filename = "{}/{}/nn_songs/{}".format(genre, instrument, name)
+                gen.write_to_midi_mido(notes, filename)
+                written.append(filename)
+
+    return written
@@ -5,12 +5,25 @@ Functions mainly responsible for generating
 notes from the RNN, as well as transcribing
 said notes to MIDI.
 """
+import io
 import numpy
-import music21 as m21
+import mido
 import helpers
+import metrics
+from fractions import Fraction
 
+# MIDI resolution and note velocity, the same as music21 writes
+TICKS_PER_QUARTER = 1024
+VELOCITY = 90
 
-def generate_notes(neural_network, num_notes):
+# note offsets are added up in thirds of a tick, so a run of triplets doesn't drift
+THIRDS_PER_QUARTER = 3 * TICKS_PER_QUARTER
+
+# duration string --> length in thirds of a tick, filled in as durations are seen
+duration_table = {}
+
+
+def generate_notes(neural_network, num_notes, temperature=None, top_k=None, seed=None, cache=None):
     """
     Given a MusicRNN, this function:
     - Grabs notes from the MusicRNN's NoteManager object
@@ -23,43 +36,159 @@ def generate_notes(neural_network, num_notes):
 
     neural_network: A MusicRNN object to use to generate notes
     num_notes: An integer indicating the number of notes to create
+    temperature, top_k: sample the notes instead of taking the most
+    likely ones, see nn.sample_codes
+    seed: an int or sequence of ints, or a numpy Generator, that picks
+    the seed window and sampled notes. The same seed always generates
+    the same notes from the same network. Random if None.
+    cache: a SectionCache to read the notes from, or store them in,
+    when an int seed is given
 
     returns a list of tuples of numerical pitches and durations
 
     example: generate_notes(myRNN, 2) --> [(34, 1.0), (43.41, .25)]
     """
 
-    training_input = neural_network.notes_manager.training_input
-    sequence_length = neural_network.notes_manager.sequence_len  # timesteps/sequence length
-    num_features = neural_network.notes_manager.num_features  # num of unique pitches+lengths (classes)
+    return generate_notes_batch(neural_network, num_notes, 1, temperature=temperature, top_k=top_k,
+                                seed=None if seed is None else [seed], cache=cache)[0]
+
+
+def split_seed(seed, num_seeds):
+    """
+    Splits a seed into num_seeds seeds, one per part of what is
+    generated from it, so each part only depends on its own seed.
+
+    seed: None, an int or sequence of ints, a numpy Generator, or a
+    list of num_seeds seeds that are returned as they are
+    returns: a list of num_seeds seeds: Nones for None, ints drawn
+    from a Generator, and (seed..., i) for part i of an int seed
+    """
+    if isinstance(seed, list):
+        if len(seed) != num_seeds:
+            raise ValueError("expected {} seeds, got {}".format(num_seeds, len(seed)))
+        return seed
+
+    if seed is None:
+        return [None] * num_seeds
+
+    if isinstance(seed, numpy.random.Generator):
+        return [int(part) for part in seed.integers(2 ** 63, size=num_seeds)]
+
+    return [tuple(int(s) for s in numpy.atleast_1d(seed)) + (i,) for i in range(num_seeds)]
+
+
+def generate_notes_batch(neural_network, num_notes, batch_size, temperature=None, top_k=None, seed=None, cache=None):
+    """
+    Generates batch_size independent sequences of notes at once, each
+    from its own random seed window. Every step makes one forward pass
+    through the MusicRNN for the whole batch. The notes are kept as
+    note codes while generating and only translated to strings at the end.
+
+    Each sequence is generated from its own seed (see split_seed), so
+    it is the same whatever else is in the batch. Sequences with an
+    int seed are read from the cache if it has them, and only the
+    others are generated.
 
-    nums = numpy.random.random_integers(len(training_input) - 1, size=(1, sequence_length))[0]
+    neural_network: A MusicRNN object to use to generate notes
+    num_notes: An integer indicating the number of notes to create
+    batch_size: An integer, the number of sequences to generate
+    temperature, top_k: as in generate_notes
+    seed: as in generate_notes, split between the sequences, or a
+    list of batch_size seeds, one per sequence
+    cache: as in generate_notes
 
-    pattern = []
-    note_output = []
+    returns a list of batch_size lists of tuples of numerical pitches and durations
+    """
 
-    for i in range(len(nums)):
-        pattern.append(training_input[nums[i]][i].tolist())
+    notes_manager = neural_network.notes_manager
+    seeds = split_seed(seed, batch_size)
+    output_codes = [None] * batch_size
 
-    for _ in range(num_notes):
+    # the cache only holds sequences that can be generated again from their seed
+    keys = [None] * batch_size
+    cacheable = [i for i, row_seed in enumerate(seeds)
+                 if row_seed is not None and not isinstance(row_seed, numpy.random.Generator)]
 
-        pred_pitch, pred_length, pred_encoded = neural_network.predict_note(numpy.reshape(pattern, (1, sequence_length, num_features)))
+    # hashing the network is only worth it if some sequence can be cached
+    if cache is not None and cacheable:
+        fingerprint = neural_network.fingerprint()
+        for i in cacheable:
+            keys[i] = cache.key(fingerprint, seeds[i], temperature=temperature, top_k=top_k)
+            output_codes[i] = cache.get(keys[i], num_notes)
 
-        # eliminate "-" sign on duration
-        fixed_duration = pred_length
-        if fixed_duration[0] == "-":
-            fixed_duration = fixed_duration[1:]
+    missing = [i for i, codes in enumerate(output_codes) if codes is None]
+    if missing:
+        rngs = [numpy.random.default_rng(seeds[i]) for i in missing]
+        generated = __generate_codes__(neural_network, num_notes, rngs, temperature, top_k)
 
-        # append the predicted note to the output
-        note_output.append((pred_pitch, fixed_duration))
+        for i, codes in zip(missing, generated):
+            output_codes[i] = codes
+            if keys[i] is not None:
+                cache.put(keys[i], codes)
 
-        pattern.append(pred_encoded[0].tolist())  # append the predicted note (encoded) to the sequence
-        pattern = pattern[1:]  # bump off the first note in the sequence
+    return [notes_manager.decode(codes) for codes in output_codes]
 
-    return note_output
 
+def __generate_codes__(neural_network, num_notes, rngs, temperature, top_k):
+    """
+    Generates one sequence of note codes per numpy Generator in rngs,
+    each seed window and sampled note drawn from its own Generator
 
-def write_to_midi(notes, filename):
+    returns a (len(rngs), num_notes, 2) array of [pitch code, length code] rows
+    """
+
+    notes_manager = neural_network.notes_manager
+    batch_size = len(rngs)
+    sequence_length = notes_manager.sequence_len  # timesteps/sequence length
+    num_features = notes_manager.num_features  # num of unique pitches+lengths (classes)
+    num_windows = len(notes_manager.note_codes) - sequence_length  # number of training windows
+
+    nums = numpy.array([rng.integers(num_windows, size=sequence_length) for rng in rngs])
+
+    # the windows are kept in a ring buffer stored twice over, so the last
+    # sequence_length notes are always the contiguous slice [head:head+sequence_length]
+    head = 0
+
+    # the code of every generated note, and the rows of the ring buffer to set them in
+    output_codes = numpy.empty((batch_size, num_notes, 2), dtype=numpy.int32)
+    rows = numpy.arange(batch_size)
+    num_lengths = notes_manager.num_lengths
+
+    # note i of each seed window is note i of a random training window,
+    # encoded straight from the note codes without building the windows
+    seed_codes = notes_manager.note_codes[nums + numpy.arange(sequence_length)]
+
+    # networks that embed their inputs take the codes themselves
+    if neural_network.embedding:
+        ring = numpy.zeros((batch_size, 2 * sequence_length, 2), dtype=numpy.int32)
+        ring[:, :sequence_length] = ring[:, sequence_length:] = seed_codes
+    else:
+        ring = numpy.zeros((batch_size, 2 * sequence_length, num_features), dtype=numpy.float32)
+        ring[:, :sequence_length] = ring[:, sequence_length:] = notes_manager.encode(
+            seed_codes.reshape(-1, 2)).reshape(batch_size, sequence_length, num_features)
+
+    for i in range(num_notes):
+
+        codes = neural_network.predict_codes(ring[:, head:head + sequence_length], temperature=temperature,
+                                             top_k=top_k, rng=rngs)
+        output_codes[:, i] = codes
+
+        # overwrite the oldest note with the predicted note, in both copies
+        if neural_network.embedding:
+            ring[:, head] = ring[:, head + sequence_length] = codes
+        else:
+            for column in (head, head + sequence_length):
+                ring[:, column] = 0
+                ring[rows, column, codes[:, 1]] = 1
+                ring[rows, column, codes[:, 0] + num_lengths] = 1
+
+        head = (head + 1) % sequence_length
+
+    return output_codes
+
+
+@metrics.timed("write_to_midi")
+def write_to_midi(notes, filename, backend="music21"):
     """
     Given a list of tuples of pitches/durations this function
     translates the numerical notation to an actual note, and
@@ -69,10 +198,21 @@ def write_to_midi(notes, filename):
 
     notes: A list of tuples
     filename: A string to save the MIDI file as
+    backend: "music21", or "mido" to write the MIDI events directly
+    (see write_to_midi_mido)
 
     Example:
         write_to_midi((50, 1.0), "my_song" --> my_song.mid
     """
+    metrics.increment("notes_written", len(notes))
+
+    if backend == "mido":
+        return write_to_midi_mido(notes, filename)
+    elif backend != "music21":
+        raise ValueError("unknown MIDI writer backend {}".format(backend))
+
+    import music21 as m21
+
     s1 = m21.stream.Stream()
 
     for n in notes:
@@ -129,3 +269,118 @@ def write_to_midi(notes, filename):
         s1.append(note)
 
     fp = s1.write('midi', fp=filename)
+
+
+def duration_thirds(duration):
+    """
+    converts a duration string, e.g. "0.25" or "1/3", to its length
+    in thirds of a MIDI tick, an int. Parsed durations are multiples
+    of 1/4 or 1/3 of a quarter, so their lengths are exact. Like
+    write_to_midi, a duration of 0 is written as an eighth note.
+    """
+    length = duration_table.get(duration)
+
+    if length is None:
+        length = int(round((Fraction(duration) or Fraction(1, 2)) * THIRDS_PER_QUARTER))
+        duration_table[duration] = length
+
+    return length
+
+
+def write_to_midi_mido(notes, filename=None):
+    """
+    Writes a list of tuples of pitches/durations straight to MIDI
+    note events with mido, without building a music21 stream. The
+    notes, timings, and velocities are the same as write_to_midi's.
+
+    notes: A list of tuples
+    filename: A string or file object to save the MIDI file to. If
+    None, the MIDI file is returned as bytes instead.
+
+    Example:
+        write_to_midi_mido([("50", "1.0")]) --> b'MThd...'
+    """
+    midi_file = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_QUARTER)
+    midi_file.tracks.append(__midi_track__(notes))
+
+    return __save_midi__(midi_file, filename)
+
+
+def write_tracks_mido(tracks, filename=None):
+    """
+    Writes several lists of tuples of pitches/durations to one MIDI
+    file, one track per list, each starting at the beginning of
+    the song and playing on its own channel.
+
+    tracks: A list of (track name, notes) pairs
+    filename: as in write_to_midi_mido
+
+    Example:
+        write_tracks_mido([("bass", [("38", "1.0")]), ("vocals", [("50", "1.0")])], "band.mid")
+    """
+    midi_file = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_QUARTER)
+
+    # channel 9 is the percussion channel, so skip it
+    channels = [channel for channel in range(16) if channel != 9]
+    for (name, notes), channel in zip(tracks, channels):
+        midi_file.tracks.append(__midi_track__(notes, channel=channel, name=name))
+
+    return __save_midi__(midi_file, filename)
+
+
+def __midi_track__(notes, channel=0, name=""):
+    """
+    returns a mido MidiTrack playing the given notes on the given channel
+    """
+    events = []  # (absolute tick, message) pairs
+    offset = 0  # in thirds of a tick
+
+    for pitch, duration in notes:
+
+        # rounded to the nearest tick, a third of a tick is never halfway
+        length = duration_thirds(duration)
+        start = (offset + 1) // 3
+        end = start + (length + 1) // 3
+        offset += length
+
+        # a rest only moves the next note along
+        if pitch == "X":
+            continue
+
+        midi_pitches = [int(p) + 12 for p in pitch.split(",")]
+
+        events.extend((start, mido.Message("note_on", channel=channel, note=p, velocity=VELOCITY))
+                      for p in midi_pitches)
+        events.extend((end, mido.Message("note_off", channel=channel, note=p, velocity=0)) for p in midi_pitches)
+
+    # rounding can end a note a tick after the next one starts
+    events.sort(key=lambda event: event[0])
+
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage("track_name", name=name, time=0))
+    track.append(mido.Message("pitchwheel", channel=channel, pitch=0, time=0))
+
+    last_tick = 0
+    for tick, message in events:
+        track.append(message.copy(time=tick - last_tick))
+        last_tick = tick
+
+    track.append(mido.MetaMessage("end_of_track", time=TICKS_PER_QUARTER))
+
+    return track
+
+
+def __save_midi__(midi_file, filename):
+    """
+    Saves a mido MidiFile to filename, a path or file object,
+    or returns it as bytes if filename is None
+    """
+    if filename is None:
+        output = io.BytesIO()
+        midi_file.save(file=output)
+        return output.getvalue()
+
+    if isinstance(filename, str):
+        midi_file.save(filename)
+    else:
+        midi_file.save(file=filename)
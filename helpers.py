@@ -5,8 +5,9 @@ helper functions that aid the rest of the RNN and
 other programs, mostly do do with translating
 and transposing notes
 """
-import music21 as m21
+import os
 import glob
+from concurrent.futures import ProcessPoolExecutor
 
 
 # dictionary converting notes to numbers
@@ -57,29 +58,69 @@ minors = dict([("G#", 1), ("A-", 1),("A", 0),("A#", -1),("B-", -1),("B", -2),("C
                ("D#", 6),("E-", 6),("E", 5),("F", 4),("F#", 3),("G-", 3),("G", 2)])
 
 
-def transpose_songs(path):
+def transpose_songs(path, workers=1, verify=False, force=False):
     """
     Given a file path, transposes all songs in that path to A minor/C major
     Courtesy of Dr. Nick Kelly
     http://nickkellyresearch.com/python-script-transpose-midi-files-c-minor/
+
+    path: a glob of the songs to transpose, e.g. "rock/bass/original_keys/*.mid"
+    workers: number of processes used to transpose songs concurrently
+    verify: if True, analyze the key of each transposed song again and print it
+    force: if True, transpose songs whose C_ file is already up to date
+    """
+
+    files = [file for file in glob.glob(path) if force or not transposed_up_to_date(file)]
+
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(transpose_song, files, [verify] * len(files)))
+    else:
+        for file in files:
+            transpose_song(file, verify)
+
+
+def transposed_file(file):
+    """
+    returns the file path a song is transposed to, C_<name> in the same folder
+    """
+    return file.rsplit('/',1)[0] + "/" + "C_" + file.rsplit('/',1)[1]
+
+
+def transposed_up_to_date(file):
+    """
+    returns True if the given song's C_ file exists and is newer than the song
     """
+    newFileName = transposed_file(file)
+    return os.path.exists(newFileName) and os.path.getmtime(newFileName) >= os.path.getmtime(file)
 
-    for file in glob.glob(path):
-        print(file)
-        score = m21.converter.parse(file)
-        key = score.analyze('key')
 
-        if key.mode == "major":
-            halfSteps = majors[key.tonic.name]
+def transpose_song(file, verify=False):
+    """
+    transposes a single song to A minor/C major, saving it as C_<name>,
+    see transpose_songs
+    """
+    import music21 as m21
+
+    print(file)
+    score = m21.converter.parse(file)
+    key = score.analyze('key')
 
-        elif key.mode == "minor":
-            halfSteps = minors[key.tonic.name]
+    if key.mode == "major":
+        halfSteps = majors[key.tonic.name]
 
-        newscore = score.transpose(halfSteps)
+    elif key.mode == "minor":
+        halfSteps = minors[key.tonic.name]
+
+    newscore = score.transpose(halfSteps)
+
+    # a second key analysis is only needed to check the result
+    if verify:
         key = newscore.analyze('key')
         print(key.tonic.name, key.mode)
-        newFileName = file.rsplit('/',1)[0] + "/" + "C_" + file.rsplit('/',1)[1]
-        newscore.write('midi', newFileName)
+
+    newFileName = transposed_file(file)
+    newscore.write('midi', newFileName)
 
 
 def convert_note(note):
@@ -117,4 +158,22 @@ def convert_number(number):
     number = int(number)
     pitch = (number % 12)
     octave = (number - pitch) // 12
-    return "{}{}".format(num_to_note_conversion[pitch], octave)
\ No newline at end of file
+    return "{}{}".format(num_to_note_conversion[pitch], octave)
+
+
+def limit_threads(intra_threads, inter_threads=1):
+    """
+    Limits the CPU threads numpy and tensorflow use in this process.
+    Call it before they do any work, e.g. first thing in a worker
+    process; the environment variables are only read on import.
+
+    intra_threads: an int, threads a single operation may use
+    inter_threads: an int, operations that may run at once
+    """
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"):
+        os.environ[variable] = str(intra_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(inter_threads)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
@@ -9,29 +9,86 @@ the main() function.
 """
 
 import sys
+import glob
 import getopt
+import metrics
+import ensemble
 import song_creator as sc
 
 
 def main(argv):
 
-    helpstring = ("main.py -t -g <song_name> -m <music genre> -i <instrument> -s <save> -l <load>\n"
+    helpstring = ("main.py -t -g <song_name> -n <count> -m <music genre> -i <instrument> -s <save> -l <load>\n"
                   "-t: trains a neural network for the specified music/instrument\n"
                   "-g: generates music for the specified music/instrument as the given song name\n"
+                  "-n: number of songs to generate in one batch, saved as <song_name>_1 ... <song_name>_n\n"
                   "-m: music genre to use\n"
                   "-i: instrument to use\n"
                   "-s: save the NN model in music/instrument/nn_model\n"
-                  "-l: load a previously saved NN model in music/instrument/nn_model")
+                  "-l: load a previously saved NN model in music/instrument/nn_model\n"
+                  "--stream: encode training batches on the fly instead of holding every window in memory\n"
+                  "--key-shift <n>: while training, shift each window into a random key up to n semitones away\n"
+                  "--metrics <file>: record the time of each stage and save it to file, in the Prometheus text "
+                  "format if it ends in .prom, as JSON otherwise\n"
+                  "-e: ensemble mode, trains or generates for every instrument of the -m genres (comma separated, "
+                  "every genre if not given) in parallel\n"
+                  "--merge: in ensemble mode, write each song's instruments to one multi-track MIDI in music/nn_songs\n"
+                  "--workers <n>: in ensemble mode, number of instruments to run at once\n"
+                  "--export-tflite <none|float16|int8>: export the NNs as TFLite models to music/instrument/nn_models, "
+                  "reporting how often their predictions agree with the NNs'\n"
+                  "--tflite: generate with the exported TFLite models\n"
+                  "--temperature <t>: sample each note from the predictions scaled by t instead of taking the most "
+                  "likely one (0 takes the most likely one)\n"
+                  "--top-k <k>: sample each note from the k most likely ones, k >= 1\n"
+                  "--parallel: train the intro, middle, and outro NNs at the same time in separate processes\n"
+                  "--intra-threads <n>, --inter-threads <n>: with --parallel, threads each process's operations may "
+                  "use and operations each process may run at once\n"
+                  "--epochs <n>: most epochs to train for, 200 by default\n"
+                  "--patience <n>: stop training a NN once its validation loss hasn't improved for n epochs\n"
+                  "--resume: carry on an interrupted training run from its last saved epoch\n"
+                  "--update <files>: add the songs matching the glob to the corpus and fine tune the loaded NNs on "
+                  "them (--epochs sets the fine tuning epochs)\n"
+                  "--embedding: train NNs that embed the pitch and length codes and predict them with two softmax "
+                  "heads, instead of taking one-hot windows\n"
+                  "--seed <n>: generate the same songs every time for the same seed, reusing sections already "
+                  "generated from it\n"
+                  "--dedup: train on each distinct window once, weighted by how often it repeats in the songs")
 
     train = False
     generate = None
+    count = 1
     music = None
     instrument = None
     save = None
     load = None
+    stream = False
+    key_shift = 0
+    metrics_file = None
+    ensemble_mode = False
+    merge = False
+    workers = None
+    export_tflite = None
+    tflite = False
+    temperature = None
+    top_k = None
+    parallel = False
+    intra_threads = None
+    inter_threads = 1
+    epochs = 200
+    patience = None
+    resume = False
+    update = None
+    architecture = "multi_hot"
+    seed = None
+    dedup = False
 
     try:
-        opts, args = getopt.getopt(argv, "tg:m:i:sl", ["train", "generate=", "music=", "instrument=", "save", "load"])
+        opts, args = getopt.getopt(argv, "tg:n:m:i:sle", ["train", "generate=", "count=", "music=", "instrument=",
+                                                          "save", "load", "stream", "key-shift=", "metrics=",
+                                                          "ensemble", "merge", "workers=", "export-tflite=",
+                                                          "tflite", "temperature=", "top-k=", "parallel",
+                                                          "intra-threads=", "inter-threads=", "epochs=", "patience=",
+                                                          "resume", "update=", "embedding", "seed=", "dedup"])
     except getopt.GetoptError:
         print(helpstring)
         sys.exit(2)
@@ -48,14 +105,82 @@ def main(argv):
             train = True
         elif opt in ("-g", "--generate"):
             generate = arg
+        elif opt in ("-n", "--count"):
+            count = int(arg)
         elif opt in ("-m", "--music"):
             music = arg
         elif opt in ("-i", "--instrument"):
             instrument = arg
         elif opt in ("-s", "--save"):
-            save = arg
+            save = True
         elif opt in ("-l", "--load"):
-            load = arg
+            load = True
+        elif opt == "--stream":
+            stream = True
+        elif opt == "--key-shift":
+            key_shift = int(arg)
+        elif opt == "--metrics":
+            metrics_file = arg
+        elif opt in ("-e", "--ensemble"):
+            ensemble_mode = True
+        elif opt == "--merge":
+            merge = True
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--export-tflite":
+            export_tflite = arg
+        elif opt == "--tflite":
+            tflite = True
+        elif opt == "--temperature":
+            temperature = float(arg)
+        elif opt == "--top-k":
+            top_k = int(arg)
+        elif opt == "--parallel":
+            parallel = True
+        elif opt == "--intra-threads":
+            intra_threads = int(arg)
+        elif opt == "--inter-threads":
+            inter_threads = int(arg)
+        elif opt == "--epochs":
+            epochs = int(arg)
+        elif opt == "--patience":
+            patience = int(arg)
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--update":
+            update = arg
+        elif opt == "--embedding":
+            architecture = "embedding"
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--dedup":
+            dedup = True
+
+    if metrics_file:
+        metrics.enable()
+
+    if (temperature is not None and temperature < 0) or (top_k is not None and top_k < 1):
+        print("--temperature must not be negative and --top-k must be at least 1")
+        sys.exit(2)
+
+    # every instrument at once
+    if ensemble_mode:
+        genres = music.split(",") if music else None
+
+        if train:
+            ensemble.train(genres, epochs=epochs, save=save, streaming=stream, key_shift=key_shift, patience=patience,
+                           resume=resume, workers=workers, architecture=architecture, dedup=dedup)
+
+        if generate:
+            written = ensemble.generate(generate, genres, num_songs=count, merge=merge, load=load and not train,
+                                        workers=workers, seed=seed, temperature=temperature, top_k=top_k,
+                                        architecture=architecture)
+            print("{} songs created: {}".format(len(written), ", ".join(written)))
+
+        if metrics_file:
+            metrics.write(metrics_file)
+
+        sys.exit(0)
 
     # error checking
     if train or generate:
@@ -65,14 +190,18 @@ def main(argv):
         if train:
             print("-l option not valid when training")
     if save:
-        if not train:
-            print("-t option required to save a NN")
+        if not train and not update:
+            print("-t or --update option required to save a NN")
 
-    nn = sc.SongCreator(music, instrument, parsed=True, epochs=200, batch_size=32)
+    nn = sc.SongCreator(music, instrument, parsed=True, epochs=epochs, batch_size=32, architecture=architecture)
 
     # train neural network if that was selected as an option
     if train:
-        nn.train()
+        if parallel:
+            nn.train_parallel(streaming=stream, key_shift=key_shift, intra_threads=intra_threads,
+                              inter_threads=inter_threads, patience=patience, resume=resume, dedup=dedup)
+        else:
+            nn.train(streaming=stream, key_shift=key_shift, patience=patience, resume=resume, dedup=dedup)
 
         # save the model if indicated
         if save:
@@ -82,17 +211,47 @@ def main(argv):
     elif load:
         nn.load_nn()
 
+    # if not trained or loaded, load the weights
+    if (generate or export_tflite or update) and not train and not load:
+        nn.load_nn_weights()
+
+    # fine tune on new songs
+    if update:
+        nn.update(sorted(glob.glob(update)), epochs=epochs, patience=patience)
+
+        if save:
+            nn.save_model()
+
+    # export the NNs for faster inference
+    if export_tflite:
+        agreement = nn.export_tflite(None if export_tflite == "none" else export_tflite)
+
+        for section, stats in agreement.items():
+            print("{}: pitch {:.1%}, length {:.1%}, both {:.1%} agree; {:.2f}x as fast".format(
+                section, stats["pitch"], stats["length"], stats["both"],
+                stats["keras_seconds"] / stats["tflite_seconds"]))
+
+    if tflite:
+        nn.use_tflite()
+
     # generate if indicated
     if generate:
 
-        # if not trained or loaded, load the weights
-        if not train and not load:
-            nn.load_nn_weights()
-
         # make the song
-        nn.create_song(generate + ".mid")
+        if count == 1:
+            nn.create_song(generate + ".mid", temperature=temperature, top_k=top_k, seed=seed)
+
+            print("Song created under {}/{}/nn_songs/{}.mid".format(music, instrument, generate))
+
+        # or a batch of songs
+        else:
+            song_names = ["{}_{}.mid".format(generate, i + 1) for i in range(count)]
+            nn.create_songs(song_names, temperature=temperature, top_k=top_k, seed=seed)
+
+            print("{} songs created under {}/{}/nn_songs/{}_<n>.mid".format(count, music, instrument, generate))
 
-        print("Song created under {}/{}/nn_songs/{}.mid".format(music, instrument, generate))
+    if metrics_file:
+        metrics.write(metrics_file)
 
     # exit
     sys.exit(0)
@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+
+"""
+Timers and counters for the stages of the pipeline: parsing,
+building training windows, training epochs, predicting notes,
+generating sections, and writing MIDI. Nothing is recorded until
+enable() is called; while disabled, a timed function costs one
+extra function call and a flag check.
+
+The recorded metrics can be exported as JSON or in the
+Prometheus text format (through prometheus_client).
+
+Example:
+    metrics.enable()
+    with metrics.timer("parse_notes"):
+        ...
+    metrics.increment("notes_parsed", 1024)
+    metrics.write("metrics.json")
+"""
+
+import json
+import time
+import threading
+import functools
+
+enabled = False
+
+# timer name --> {count, total, min, max} in seconds
+_timers = {}
+# counter name --> total
+_counters = {}
+_lock = threading.Lock()
+
+
+def enable():
+    """
+    Starts recording metrics
+    """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """
+    Stops recording metrics. What has been recorded is kept.
+    """
+    global enabled
+    enabled = False
+
+
+def reset():
+    """
+    Forgets every recorded timer and counter
+    """
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def record(name, seconds):
+    """
+    Adds one timing to the named timer
+
+    name: a string, the timer's name
+    seconds: a float, the time taken
+    """
+    if not enabled:
+        return
+
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = {"count": 1, "total": seconds, "min": seconds, "max": seconds}
+        else:
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["min"] = min(stats["min"], seconds)
+            stats["max"] = max(stats["max"], seconds)
+
+
+def increment(name, value=1):
+    """
+    Adds value to the named counter
+
+    name: a string, the counter's name
+    value: a number to add
+    """
+    if not enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+class _Timer:
+    """
+    Context manager that records the time spent inside it
+    under the given timer name
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    """
+    Context manager used while metrics are disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    """
+    Returns a context manager timing the code inside it
+
+    name: a string, the timer's name
+    """
+    if not enabled:
+        return _null_timer
+    return _Timer(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of the decorated function
+
+    name: a string, the timer's name
+    """
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot():
+    """
+    returns a copy of the recorded metrics as a dict of
+    {"timers": {name: {count, total, min, max, mean}}, "counters": {name: total}}
+    """
+    with _lock:
+        timers = {name: dict(stats, mean=stats["total"] / stats["count"]) for name, stats in _timers.items()}
+        counters = dict(_counters)
+
+    return {"timers": timers, "counters": counters}
+
+
+def merge(recorded):
+    """
+    Adds metrics recorded elsewhere, e.g. a snapshot taken in a
+    worker process, to the ones recorded here
+
+    recorded: a dict as returned by snapshot
+    """
+    if not enabled:
+        return
+
+    with _lock:
+        for name, other in recorded["timers"].items():
+            stats = _timers.get(name)
+            if stats is None:
+                _timers[name] = {key: other[key] for key in ("count", "total", "min", "max")}
+            else:
+                stats["count"] += other["count"]
+                stats["total"] += other["total"]
+                stats["min"] = min(stats["min"], other["min"])
+                stats["max"] = max(stats["max"], other["max"])
+
+        for name, total in recorded["counters"].items():
+            _counters[name] = _counters.get(name, 0) + total
+
+
+def to_json():
+    """
+    returns the recorded metrics as a JSON string
+    """
+    return json.dumps(snapshot(), indent=2, sort_keys=True)
+
+
+class _Collector:
+    """
+    prometheus_client collector exposing the recorded metrics.
+    Timers are summaries labelled by stage, counters are counters
+    labelled by name.
+    """
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, SummaryMetricFamily
+
+        recorded = snapshot()
+
+        stages = SummaryMetricFamily("music_rnn_stage_seconds", "Time spent in each stage of the pipeline",
+                                     labels=["stage"])
+        for name, stats in sorted(recorded["timers"].items()):
+            stages.add_metric([name], count_value=stats["count"], sum_value=stats["total"])
+        yield stages
+
+        counters = CounterMetricFamily("music_rnn_events", "Counts of items processed by the pipeline",
+                                       labels=["name"])
+        for name, total in sorted(recorded["counters"].items()):
+            counters.add_metric([name], total)
+        yield counters
+
+
+def to_prometheus():
+    """
+    returns the recorded metrics in the Prometheus text format.
+    Needs prometheus_client.
+    """
+    try:
+        from prometheus_client import CollectorRegistry, generate_latest
+    except ImportError:
+        raise ImportError("prometheus_client is needed to export metrics in the Prometheus format")
+
+    registry = CollectorRegistry()
+    registry.register(_Collector())
+    return generate_latest(registry).decode("utf-8")
+
+
+def write(filename):
+    """
+    Saves the recorded metrics. Files ending in .prom are written in
+    the Prometheus text format (e.g. for node_exporter's textfile
+    collector), anything else as JSON.
+
+    filename: a string, the file to save the metrics to
+    """
+    if filename.endswith(".prom"):
+        text = to_prometheus()
+    else:
+        text = to_json()
+
+    with open(filename, "w") as fw:
+        fw.write(text)
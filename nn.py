@@ -1,23 +1,211 @@
 #!/usr/bin/python3
 
+import os
+import json
+import time
+import hashlib
+import threading
 import keras
 import numpy
 import tensorflow as tf
-from keras.callbacks import ModelCheckpoint
-from keras import Sequential
-from keras.layers import Dense, Dropout, LSTM, Bidirectional, CuDNNLSTM
+import parse_midi as pm
+import metrics
+from keras import backend as K
+from keras.callbacks import Callback, EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
+from keras import Sequential, Model
+from keras.layers import Dense, Dropout, LSTM, Bidirectional, CuDNNLSTM, Concatenate, Embedding, Input
+
+# the input representations a MusicRNN can be built with
+ARCHITECTURES = ("multi_hot", "embedding")
+
+# sizes of the pitch and length embeddings of the "embedding" architecture
+PITCH_EMBEDDING_DIM = 64
+LENGTH_EMBEDDING_DIM = 16
+
+
+class NotesSequence(keras.utils.Sequence):
+    """
+    Streams (window, next note) training batches from a NotesManager.
+    Only the integer note codes are kept in memory; each batch is
+    one-hot encoded when keras asks for it, or, for networks that
+    embed their inputs, handed over as integer codes.
+    """
+
+    def __init__(self, notes_manager, starts, batch_size=32, shuffle=True, max_shift=0, codes=False, weights=None):
+        """
+        notes_manager: the NotesManager to take the notes from
+        starts: the note indices of the windows in this sequence
+        batch_size: an int, the number of windows per batch
+        shuffle: a Bool, set to True to shuffle the windows every epoch
+        max_shift: an int, if > 0 every window is shifted by a random
+        -max_shift..max_shift semitones each time it is encoded
+        codes: a Bool, set to True for batches of integer codes (see
+        NotesManager.code_windows) instead of one-hot encoded windows
+        weights: an optional array of a sample weight per window, given
+        to keras with each batch
+        """
+        self.notes_manager = notes_manager
+        self.starts = numpy.array(starts)
+        self.weights = None if weights is None else numpy.asarray(weights, dtype=numpy.float32)
+        self.codes = codes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.max_shift = max_shift
+        self.windows = notes_manager.code_windows if codes else notes_manager.encode_windows
+
+        if self.shuffle:
+            self.__shuffle__()
+
+    def __shuffle__(self):
+        # the weights are shuffled along with their windows
+        order = numpy.random.permutation(len(self.starts))
+        self.starts = self.starts[order]
+        if self.weights is not None:
+            self.weights = self.weights[order]
+
+    def __len__(self):
+        return int(numpy.ceil(len(self.starts) / self.batch_size))
+
+    def __getitem__(self, index):
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        starts = self.starts[batch]
+
+        if self.max_shift:
+            shifts = self.notes_manager.random_shifts(starts, self.max_shift)
+            windows = self.windows(starts, shifts)
+        else:
+            windows = self.windows(starts)
+
+        if self.weights is None:
+            return windows
+
+        # code batches have a pitch and a length output, each weighted the same
+        weights = self.weights[batch]
+        return windows + ([weights, weights] if self.codes else weights,)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.__shuffle__()
+
+
+class EpochMetrics(Callback):
+    """
+    Records the time of every training epoch and the number
+    of epochs run under the train_epoch timer
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        metrics.record("train_epoch", time.perf_counter() - self._start)
+        metrics.increment("train_epochs")
+
+
+class QueueProgress(Callback):
+    """
+    Reports the end of every training epoch as a
+    ("epoch", name, epoch, logs) message on a queue, e.g. to
+    follow training running in another process
+    """
+
+    def __init__(self, progress, name):
+        """
+        progress: a queue, e.g. a multiprocessing.Queue
+        name: a string sent with every message, e.g. the section
+        """
+        super().__init__()
+        self.progress = progress
+        self.name = name
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = {key: float(value) for key, value in (logs or {}).items()}
+        self.progress.put(("epoch", self.name, epoch + 1, logs))
+
+
+class ResumeCheckpoint(Callback):
+    """
+    Saves the whole model, optimizer state included, as
+    <filename>.last.hdf5 after every epoch, with the epoch
+    reached in <filename>.state.json, so that an interrupted
+    run can be resumed (see MusicRNN.train).
+    """
+
+    def __init__(self, filename, checkpoint):
+        """
+        filename: the filename the run's weights are saved under
+        checkpoint: the run's ModelCheckpoint, whose best loss is saved too
+        """
+        super().__init__()
+        self.filename = filename
+        self.checkpoint = checkpoint
+        self._epoch = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._epoch = epoch + 1
+        self.__save__(finished=False)
+
+    def on_train_end(self, logs=None):
+        self.__save__(finished=True)
+
+    def __save__(self, finished):
+        self.model.save("{}.last.hdf5".format(self.filename))
+
+        # write the state to a temporary file first, so it is never left half written
+        state_fp = "{}.state.json".format(self.filename)
+        with open(state_fp + ".tmp", "w") as fw:
+            json.dump({"epoch": self._epoch, "best": float(self.checkpoint.best), "finished": finished}, fw)
+        os.replace(state_fp + ".tmp", state_fp)
+
+    @staticmethod
+    def load_state(filename):
+        """
+        returns the state saved for the run under filename,
+        or None if there is none
+        """
+        state_fp = "{}.state.json".format(filename)
+        if not (os.path.exists(state_fp) and os.path.exists("{}.last.hdf5".format(filename))):
+            return None
+
+        with open(state_fp) as fp:
+            return json.load(fp)
 
 
 class MusicRNN:
 
-    def __init__(self, notes_manager, epochs=100, batch_size=32):
+    def __init__(self, notes_manager, epochs=100, batch_size=32, model=None, architecture="multi_hot"):
+        """
+        notes_manager: the NotesManager of the notes to learn
+        epochs: an int, number of epochs to train for
+        batch_size: an int, the batch size used for training
+        model: an already built keras model, e.g. from a bundle
+        architecture: "multi_hot", where each step is one vector of every
+        pitch and length class, or "embedding", where the pitch and length
+        codes go through embedding layers and are predicted by two
+        softmax heads (see __embedding_model__)
+        """
 
         # notes manager
         self.notes_manager = notes_manager
         self.num_features = notes_manager.num_features
 
+        if architecture not in ARCHITECTURES:
+            raise ValueError("unknown architecture {}".format(architecture))
+        self.architecture = architecture
+
+        # an already built model, e.g. from a bundle
+        if model is not None:
+            self._model = model
+
+        elif architecture == "embedding":
+            self._model = self.__embedding_model__()
+
         # use the GPU, if available, for faster training
-        if tf.test.is_gpu_available():
+        elif tf.test.is_gpu_available():
             self._model = Sequential()
             self._model.add(
                 Bidirectional(LSTM(256, return_sequences=True, activation='tanh', input_shape=(16, self.num_features))))
@@ -34,53 +222,345 @@ class MusicRNN:
             self._model.add(Dense(self.num_features, activation='sigmoid'))
             print("using CPU")
 
-        self._model.compile(loss='categorical_crossentropy', optimizer='adam')
+        if model is None and architecture == "multi_hot":
+            self._model.compile(loss='categorical_crossentropy', optimizer='adam')
 
         self._epochs = epochs
         self._batch_size = batch_size
 
-    def train(self, training_input, training_output, filename=None):
+        self._step_function = None  # compiled forward pass, see predict_step
+        self._fingerprint = None  # hash of the weights and notes, see fingerprint
+
+    def __embedding_model__(self):
+        """
+        builds and compiles the "embedding" architecture: the pitch and
+        length codes of each step are embedded and concatenated, go
+        through the same two Bidirectional LSTMs as the multi-hot
+        model, and the next pitch and length are predicted by two
+        softmax heads. The input is a few small vectors per step instead
+        of one num_features wide vector.
+        """
+        sequence_len = self.notes_manager.sequence_len
+        activation = 'tanh' if tf.test.is_gpu_available() else 'relu'
+
+        pitch_input = Input(shape=(sequence_len,), dtype='int32', name='pitch_codes')
+        length_input = Input(shape=(sequence_len,), dtype='int32', name='length_codes')
+
+        pitch_embedding = Embedding(self.notes_manager.num_pitches, PITCH_EMBEDDING_DIM,
+                                    name='pitch_embedding')(pitch_input)
+        length_embedding = Embedding(self.notes_manager.num_lengths, LENGTH_EMBEDDING_DIM,
+                                     name='length_embedding')(length_input)
+
+        hidden = Concatenate()([pitch_embedding, length_embedding])
+        hidden = Bidirectional(LSTM(256, return_sequences=True, activation=activation))(hidden)
+        hidden = Dropout(.2)(hidden)
+        hidden = Bidirectional(LSTM(256))(hidden)
+
+        pitch_output = Dense(self.notes_manager.num_pitches, activation='softmax', name='pitch')(hidden)
+        length_output = Dense(self.notes_manager.num_lengths, activation='softmax', name='length')(hidden)
+
+        model = Model(inputs=[pitch_input, length_input], outputs=[pitch_output, length_output])
+        model.compile(loss='sparse_categorical_crossentropy', optimizer='adam')
+
+        return model
+
+    @property
+    def embedding(self):
+        """
+        True if the network takes integer note codes rather than
+        one-hot encoded windows
+        """
+        return self.architecture == "embedding"
+
+    def training_data(self, dedup=False, validation_split=.33):
+        """
+        returns the training input and output of the notes manager's
+        windows in the form this network's architecture trains on, their
+        sample weights, and the validation data, as train takes them
+
+        dedup: a Bool, set to True to keep each distinct (window, next
+        note) example of the training windows only once (see
+        NotesManager.unique_windows), weighted by the number of times it
+        occurs. The weights average one, so the weighted loss is the loss
+        over every training window, while an epoch only goes over the
+        distinct ones. The windows are split by corpus position first, as
+        train does without dedup, and the last validation_split of them
+        are returned untouched as the validation data. Otherwise the
+        weights and validation data are None.
+        validation_split: fraction of the windows held out for validation
+        """
+        if self.embedding:
+            training_input, training_output = self.notes_manager.create_code_sequences()
+        else:
+            training_input, training_output = self.notes_manager.create_sequences()
+
+        if not dedup:
+            return training_input, training_output, None, None
+
+        split_at = int(len(training_input) * (1. - validation_split))
+        starts, counts = self.notes_manager.unique_windows(numpy.arange(split_at))
+
+        return (training_input[starts], training_output[starts], __sample_weights__(counts),
+                (training_input[split_at:], training_output[split_at:]))
+
+    def train(self, training_input, training_output, filename=None, callbacks=None, patience=None, resume=False,
+              sample_weight=None, validation_data=None):
         """
         Trains the RNN with the given training data
 
-        training_input:
-        training_output:
+        training_input: the windows, see training_data
+        training_output: the note after each window
         filename: an optional filename to save the model weights
+        callbacks: an optional list of more keras callbacks
+        patience: an optional int, stop once the validation loss hasn't
+        improved for this many epochs, and halve the learning rate
+        after half as many
+        resume: a Bool, set to True to carry on from the last epoch
+        saved under filename (see ResumeCheckpoint)
+        sample_weight: an optional array of a weight per window, see training_data
+        validation_data: an optional (input, output) pair to validate on.
+        By default the last third of the windows is held out.
+        """
+        callbacks_list, initial_epoch = self.__training_callbacks__(filename, callbacks, patience, resume)
+        if initial_epoch is None:
+            return
+
+        # code windows are split into the pitch and length inputs and outputs
+        if self.embedding:
+            training_input = [training_input[..., 0], training_input[..., 1]]
+            training_output = [training_output[:, 0], training_output[:, 1]]
+            if sample_weight is not None:
+                sample_weight = [sample_weight, sample_weight]
+            if validation_data is not None:
+                validation_input, validation_output = validation_data
+                validation_data = ([validation_input[..., 0], validation_input[..., 1]],
+                                   [validation_output[:, 0], validation_output[:, 1]])
+
+        if validation_data is None:
+            validation = {"validation_split": .33}
+        else:
+            validation = {"validation_data": validation_data}
+
+        self._model.fit(training_input, training_output, callbacks=callbacks_list, epochs=self._epochs,
+                        batch_size=self._batch_size, initial_epoch=initial_epoch, sample_weight=sample_weight,
+                        verbose=0 if filename else 1, **validation)
+        self._fingerprint = None
+
+    def train_streaming(self, filename=None, workers=1, validation_split=.33, max_shift=0, callbacks=None,
+                        patience=None, resume=False, dedup=False):
+        """
+        Trains the RNN on batches that are encoded on the fly from the
+        notes manager's note codes, so that only one batch of windows
+        is ever held as dense tensors. Like train, the last third of the
+        windows are held out for validation.
+
+        filename: an optional filename to save the model weights
+        workers: number of threads preparing batches while the model trains
+        validation_split: fraction of the windows held out for validation
+        max_shift: an int, if > 0 the training windows are shifted into a
+        random key up to max_shift semitones away every epoch
+        callbacks, patience, resume: as in train
+        dedup: a Bool, set to True to train on each distinct training
+        window once, weighted by its count (see training_data). The
+        validation windows are kept as they are.
+        """
+        num_windows = max(len(self.notes_manager.note_codes) - self.notes_manager.sequence_len, 0)
+        split_at = int(num_windows * (1. - validation_split))
+
+        starts, weights = numpy.arange(split_at), None
+        if dedup:
+            starts, counts = self.notes_manager.unique_windows(starts)
+            weights = __sample_weights__(counts)
+
+        training_batches = NotesSequence(self.notes_manager, starts, batch_size=self._batch_size,
+                                         max_shift=max_shift, codes=self.embedding, weights=weights)
+        validation_batches = NotesSequence(self.notes_manager, numpy.arange(split_at, num_windows),
+                                           batch_size=self._batch_size, shuffle=False, codes=self.embedding)
+
+        callbacks_list, initial_epoch = self.__training_callbacks__(filename, callbacks, patience, resume)
+        if initial_epoch is None:
+            return
+
+        self._model.fit_generator(training_batches, validation_data=validation_batches,
+                                  callbacks=callbacks_list, epochs=self._epochs, workers=workers,
+                                  initial_epoch=initial_epoch, verbose=0 if filename else 1)
+        self._fingerprint = None
+
+    def __training_callbacks__(self, filename, callbacks, patience, resume):
+        """
+        Builds the callbacks of a training run, and, when resuming,
+        loads the model and optimizer as they were after the last
+        saved epoch.
+
+        returns: the callbacks, and the epoch to start from, or None
+        if the saved run had already finished
         """
-        # if a file name is given, save the weights during training
+        callbacks_list = self.__metrics_callbacks__() + list(callbacks or [])
+        initial_epoch = 0
+        best = None
+
+        if resume:
+            if not filename:
+                raise ValueError("resuming training needs the filename the run was saved under")
+
+            state = ResumeCheckpoint.load_state(filename)
+            if state is not None:
+                self.load("{}.last.hdf5".format(filename))
+                if state["finished"]:
+                    return callbacks_list, None
+
+                initial_epoch = state["epoch"]
+                best = state["best"]
+
+        # stop once the validation loss stops improving, lowering the learning rate first
+        if patience:
+            callbacks_list.append(EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True))
+            callbacks_list.append(ReduceLROnPlateau(monitor='val_loss', factor=.5, patience=max(1, patience // 2),
+                                                    min_lr=1e-5, verbose=1))
+
+        # if a file name is given, save the best weights and the last epoch during training
         if filename:
+            # the weights folder isn't part of a fresh checkout
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+
             filepath = "{}.weights.best.hdf5".format(filename)
-            checkpoint = ModelCheckpoint(filepath, monitor='loss', verbose=1, save_best_only=True, mode='min')
-            callbacks_list = [checkpoint]
-            self._model.fit(training_input, training_output, callbacks=callbacks_list, validation_split=.33,
-                            epochs=self._epochs, batch_size=self._batch_size, verbose=0)
-        else:
-            self._model.fit(training_input, training_output, epochs=self._epochs,
-                            validation_split=.33, batch_size=self._batch_size)
+            checkpoint = ModelCheckpoint(filepath, monitor='val_loss', verbose=1, save_best_only=True, mode='min')
+            if best is not None:
+                checkpoint.best = best
+            callbacks_list.append(checkpoint)
+            callbacks_list.append(ResumeCheckpoint(filename, checkpoint))
+
+        return callbacks_list, initial_epoch
+
+    @staticmethod
+    def __metrics_callbacks__():
+        """
+        returns the callbacks recording training metrics, none
+        unless metrics are enabled
+        """
+        if metrics.enabled:
+            return [EpochMetrics()]
+        return []
 
+    def predict_step(self, prediction_input):
+        """
+        Runs the NN forward on a batch of windows. The forward pass is
+        compiled into a backend function the first time it is called,
+        so each call is one graph execution without model.predict's
+        per-call setup.
+
+        prediction_input: a (batch, sequence_len, num_features) array, or
+        for the "embedding" architecture a (batch, sequence_len, 2) array
+        of [pitch code, length code] rows
+        returns: a (batch, num_features) array of predictions, lengths first
+        """
+        if self._step_function is None:
+            if not self._model.built:
+                self._model.build((None, self.notes_manager.sequence_len, self.num_features))
+            self._step_function = K.function(self._model.inputs, self._model.outputs)
+
+        # the two heads are laid out as one prediction, the same as the multi-hot model's
+        if self.embedding:
+            pitch_predictions, length_predictions = self._step_function([prediction_input[..., 0],
+                                                                         prediction_input[..., 1]])
+            return numpy.concatenate([length_predictions, pitch_predictions], axis=1)
+
+        return self._step_function([prediction_input])[0]
+
+    @metrics.timed("predict_note")
     def predict_note(self, prediction_input):
         """
         Predicts a single note (pitch, len) based on input to the trained
         NN
         """
-        encoder = self.notes_manager.one_hot_encoder
-        classes = encoder.classes_  # array of classes of pitches and lengths
+        pitch_predictions, length_predictions, predictions_encoded = self.predict_notes(prediction_input[:1])
+
+        # return the normal prediction and the one-hot encoded prediction
+        return pitch_predictions[0], length_predictions[0], predictions_encoded
+
+    @metrics.timed("predict_notes")
+    def predict_notes(self, prediction_input):
+        """
+        Predicts the next note (pitch, len) of every window in a batch
+        with a single forward pass through the NN
+
+        prediction_input: a (batch, sequence_len, num_features) array
+        returns: an array of pitches, an array of lengths, and the
+        (batch, num_features) one-hot encoded predictions
+        """
+        codes = self.predict_codes(prediction_input)
+
+        pitch_predictions = numpy.array(self.notes_manager.pitch_vocab)[codes[:, 0]]
+        length_predictions = numpy.array(self.notes_manager.length_vocab)[codes[:, 1]]
+
+        return pitch_predictions, length_predictions, self.notes_manager.encode(codes)
+
+    @metrics.timed("predict_codes")
+    def predict_codes(self, prediction_input, temperature=None, top_k=None, rng=None):
+        """
+        Predicts the next note of every window in a batch as note
+        codes, indices into the notes manager's pitch and length
+        vocabularies, without translating them to strings.
+
+        prediction_input: a (batch, sequence_len, num_features) array
+        temperature: a float, if given the pitch and length are sampled
+        from the predictions sharpened (< 1) or flattened (> 1) by it,
+        instead of taking the most likely ones
+        top_k: an int, if given the pitch and length are sampled from
+        only the k most likely of each
+        rng: the numpy Generator, or list of one per window, to sample
+        with, see sample_codes
+        returns: a (batch, 2) array of [pitch code, length code] rows
+        """
         num_lengths = self.notes_manager.num_lengths  # number of note lengths in our input
 
-        prediction_array = self._model.predict(prediction_input)[0]  # prediction array from NN
+        prediction_array = self.predict_step(prediction_input)  # prediction arrays from NN
 
-        pitch_prediction = classes[numpy.argmax(prediction_array[num_lengths:]) + num_lengths]
-        length_prediction = classes[numpy.argmax(prediction_array[:num_lengths])]
-        prediction_encoded = encoder.transform([[pitch_prediction, length_prediction]])
+        codes = numpy.empty((len(prediction_array), 2), dtype=numpy.int32)
+        codes[:, 0] = sample_codes(prediction_array[:, num_lengths:], temperature, top_k, rng)
+        codes[:, 1] = sample_codes(prediction_array[:, :num_lengths], temperature, top_k, rng)
 
-        # return the normal prediction and the one-hot encoded prediction
-        return pitch_prediction, length_prediction, prediction_encoded
+        metrics.increment("notes_predicted", len(prediction_array))
+
+        return codes
+
+    def fingerprint(self):
+        """
+        returns a hash of everything the network's generated notes
+        depend on: its architecture, vocabularies, weights, the TFLite
+        model it runs through if any, and the notes seed windows are
+        taken from. Generated sections are cached under it (see
+        section_cache).
+
+        The hash is kept until the weights or the TFLite model change,
+        so it is only computed once per loaded network.
+        """
+        if self._fingerprint is not None:
+            return self._fingerprint
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps([self.architecture, self.notes_manager.sequence_len, self.notes_manager.length_vocab,
+                                  self.notes_manager.pitch_vocab]).encode("utf-8"))
+
+        for weights in self._model.get_weights():
+            digest.update(numpy.ascontiguousarray(weights).tobytes())
+
+        if isinstance(self._step_function, TFLiteStep):
+            with open(self._step_function.filename, "rb") as fp:
+                digest.update(fp.read())
+
+        digest.update(numpy.ascontiguousarray(self.notes_manager.note_codes).tobytes())
+
+        self._fingerprint = digest.hexdigest()
+        return self._fingerprint
 
     def load(self, filename):
         """
         loads the given model to the neural network.
         """
         self._model = keras.models.load_model(filename)
+        self._step_function = None
+        self._fingerprint = None
 
     def save(self, filename):
         """
@@ -88,10 +568,377 @@ class MusicRNN:
         """
         self._model.save(filename)
 
+    def save_bundle(self, path):
+        """
+        saves a self-contained bundle of this neural network to the
+        given folder, everything needed to generate notes with it:
+        - model.hdf5: the model's architecture and weights
+        - notes.corpus: the note vocabulary and the notes seed
+        windows are drawn from, as a note corpus
+        - bundle.json: the classes, number of lengths, sequence
+        length, and architecture the model was trained with
+        """
+        os.makedirs(path, exist_ok=True)
+
+        self._model.save("{}/model.hdf5".format(path))
+
+        notes_manager = self.notes_manager
+        pm.write_codes(notes_manager.pitch_vocab, notes_manager.length_vocab, notes_manager.note_codes,
+                       "{}/notes.corpus".format(path))
+
+        with open("{}/bundle.json".format(path), "w") as fw:
+            json.dump({"classes": notes_manager.length_vocab + notes_manager.pitch_vocab,
+                       "num_lengths": notes_manager.num_lengths,
+                       "sequence_len": notes_manager.sequence_len,
+                       "architecture": self.architecture}, fw)
+
+    @classmethod
+    def load_bundle(cls, path, epochs=100, batch_size=32):
+        """
+        loads a bundle saved by save_bundle as a MusicRNN that is
+        ready to generate notes. No training data is read and no
+        model is fit, so loading doesn't depend on the corpus size.
+        """
+        with open("{}/bundle.json".format(path)) as fp:
+            bundle = json.load(fp)
+
+        notes_manager = pm.NotesManager("{}/notes.corpus".format(path), sequence_len=bundle["sequence_len"])
+
+        if (notes_manager.length_vocab + notes_manager.pitch_vocab != bundle["classes"] or
+                notes_manager.num_lengths != bundle["num_lengths"]):
+            raise ValueError("the notes in bundle {} don't match its classes".format(path))
+
+        model = keras.models.load_model("{}/model.hdf5".format(path))
+
+        return cls(notes_manager, epochs=epochs, batch_size=batch_size, model=model,
+                   architecture=bundle.get("architecture", "multi_hot"))
+
     def load_weights(self, filename):
         """
         loads the specified weights to the neural network.
+        The model is built for its input shape first, so no
+        training data is needed.
         """
-        self._model.fit(self.notes_manager.training_input,
-                        self.notes_manager.training_output, epochs=0)
+        if self.architecture == "multi_hot" and not self._model.built:
+            self._model.build((None, self.notes_manager.sequence_len, self.num_features))
         self._model.load_weights(filename)
+        self._fingerprint = None
+
+    def remap(self, notes_manager):
+        """
+        returns a MusicRNN for a notes manager with a different
+        vocabulary, e.g. one that grew as songs were added, that keeps
+        everything this network learned. Weights are matched up by
+        class name: the input kernel rows and output columns of known
+        pitches and lengths are copied, and those of new classes start
+        out at zero inputs and an unlikely output.
+
+        notes_manager: the NotesManager of the new vocabulary
+        """
+        if self.embedding:
+            return self.__remap_embedding__(notes_manager)
+
+        old_classes = self.notes_manager.length_vocab + self.notes_manager.pitch_vocab
+        new_classes = notes_manager.length_vocab + notes_manager.pitch_vocab
+
+        # the old feature each new feature comes from, or -1 for a new class
+        old_index = {c: i for i, c in enumerate(old_classes)}
+        source = numpy.array([old_index.get(c, -1) for c in new_classes])
+        known = source >= 0
+
+        remapped = MusicRNN(notes_manager, epochs=self._epochs, batch_size=self._batch_size)
+
+        sequence_len = notes_manager.sequence_len
+        if not self._model.built:
+            self._model.build((None, sequence_len, self.num_features))
+        if not remapped._model.built:
+            remapped._model.build((None, sequence_len, remapped.num_features))
+
+        first_layer, last_layer = self._model.layers[0], self._model.layers[-1]
+
+        for old_layer, new_layer in zip(self._model.layers, remapped._model.layers):
+            weights = old_layer.get_weights()
+
+            # the input kernels have a row per input feature
+            if old_layer is first_layer:
+                for i, variable in enumerate(old_layer.weights):
+                    if "kernel" in variable.name and "recurrent" not in variable.name:
+                        kernel = numpy.zeros((len(new_classes),) + weights[i].shape[1:], dtype=weights[i].dtype)
+                        kernel[known] = weights[i][source[known]]
+                        weights[i] = kernel
+
+            # the output kernel and bias have a column per output feature
+            elif old_layer is last_layer:
+                kernel, bias = weights
+                new_kernel = numpy.zeros((kernel.shape[0], len(new_classes)), dtype=kernel.dtype)
+                new_kernel[:, known] = kernel[:, source[known]]
+                new_bias = numpy.full(len(new_classes), bias.min(), dtype=bias.dtype)
+                new_bias[known] = bias[source[known]]
+                weights = [new_kernel, new_bias]
+
+            new_layer.set_weights(weights)
+
+        return remapped
+
+    def __remap_embedding__(self, notes_manager):
+        """
+        remap for the "embedding" architecture: the pitch and length
+        embeddings have a row per class, and the pitch and length
+        heads a column per class, each matched up within its own vocabulary
+        """
+        sources = {"pitch": __vocab_source__(self.notes_manager.pitch_vocab, notes_manager.pitch_vocab),
+                   "length": __vocab_source__(self.notes_manager.length_vocab, notes_manager.length_vocab)}
+
+        remapped = MusicRNN(notes_manager, epochs=self._epochs, batch_size=self._batch_size,
+                            architecture=self.architecture)
+
+        for old_layer, new_layer in zip(self._model.layers, remapped._model.layers):
+            weights = old_layer.get_weights()
+
+            if old_layer.name in ("pitch_embedding", "length_embedding"):
+                source = sources[old_layer.name.split("_")[0]]
+                known = source >= 0
+                embeddings = numpy.zeros((len(source), weights[0].shape[1]), dtype=weights[0].dtype)
+                embeddings[known] = weights[0][source[known]]
+                weights = [embeddings]
+
+            elif old_layer.name in ("pitch", "length"):
+                source = sources[old_layer.name]
+                known = source >= 0
+                kernel, bias = weights
+                new_kernel = numpy.zeros((kernel.shape[0], len(source)), dtype=kernel.dtype)
+                new_kernel[:, known] = kernel[:, source[known]]
+                new_bias = numpy.full(len(source), bias.min(), dtype=bias.dtype)
+                new_bias[known] = bias[source[known]]
+                weights = [new_kernel, new_bias]
+
+            new_layer.set_weights(weights)
+
+        return remapped
+
+    def fine_tune(self, new_from, replay=.25, epochs=None, filename=None, patience=None, workers=1):
+        """
+        Trains the RNN only on the windows that hold notes added to
+        the corpus since it was trained, plus a random replay sample
+        of the older windows so it doesn't forget them, so fine tuning
+        costs about as much as the new notes. The last third of the new
+        windows is held out for validation.
+
+        new_from: an int, the index of the first new note in the notes
+        manager's corpus (see parse_midi.append_notes)
+        replay: a float, the number of old windows to train on again,
+        as a fraction of the number of new windows
+        epochs: an int, the number of epochs to fine tune for, the
+        network's epochs by default
+        filename, patience: as in train
+        workers: number of threads preparing batches while the model trains
+        """
+        sequence_len = self.notes_manager.sequence_len
+        num_windows = max(len(self.notes_manager.note_codes) - sequence_len, 0)
+
+        # every window that predicts or holds a new note
+        first_new = min(max(new_from - sequence_len, 0), num_windows)
+        new_starts = numpy.arange(first_new, num_windows)
+        if len(new_starts) == 0:
+            return
+
+        split_at = int(len(new_starts) * (1. - .33))
+        num_replay = min(int(len(new_starts) * replay), first_new)
+        replay_starts = numpy.random.choice(first_new, size=num_replay, replace=False)
+
+        training_batches = NotesSequence(self.notes_manager, numpy.concatenate([new_starts[:split_at], replay_starts]),
+                                         batch_size=self._batch_size, codes=self.embedding)
+        validation_batches = NotesSequence(self.notes_manager, new_starts[split_at:], batch_size=self._batch_size,
+                                           shuffle=False, codes=self.embedding)
+
+        callbacks_list, _ = self.__training_callbacks__(filename, None, patience, False)
+
+        self._model.fit_generator(training_batches, validation_data=validation_batches,
+                                  callbacks=callbacks_list, epochs=epochs or self._epochs, workers=workers,
+                                  verbose=0 if filename else 1)
+        self._fingerprint = None
+
+    def export_tflite(self, filename, quantization=None):
+        """
+        exports the model's forward pass as a TFLite model, for
+        faster inference on CPU (see use_tflite).
+
+        filename: the file to save the TFLite model to
+        quantization: None to keep float32 weights, "float16" to
+        store the weights as float16, or "int8" to quantize the
+        weights to int8. Activations stay float: calibrating them to
+        int8 collapses the LSTMs' outputs to a constant.
+        """
+        if self.embedding:
+            raise ValueError("only multi_hot networks can be exported to TFLite")
+
+        sequence_len = self.notes_manager.sequence_len
+
+        if not self._model.built:
+            self._model.build((None, sequence_len, self.num_features))
+
+        # the converter takes a tf.keras model, so rebuild the model there with the same weights
+        tf_model = tf.keras.models.model_from_json(self._model.to_json())
+        tf_model.set_weights(self._model.get_weights())
+
+        # traced with no fixed batch size, since generation runs whole batches of windows through it
+        forward = tf.function(lambda windows: tf_model(windows, training=False))
+        concrete_function = forward.get_concrete_function(
+            tf.TensorSpec([None, sequence_len, self.num_features], tf.float32))
+
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function])
+        converter.experimental_new_converter = True
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+        if quantization == "float16":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+
+        elif quantization == "int8":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+        elif quantization is not None:
+            raise ValueError("unknown quantization {}".format(quantization))
+
+        tflite_model = converter.convert()
+
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "wb") as fw:
+            fw.write(tflite_model)
+
+    def use_tflite(self, filename):
+        """
+        runs predict_step, and so predict_note and generate_notes,
+        through a TFLite model saved by export_tflite instead of the
+        keras model. Calling load or load_bundle goes back to keras.
+        """
+        self._step_function = TFLiteStep(filename)
+        self._fingerprint = None
+
+    def prediction_agreement(self, filename, num_windows=1024):
+        """
+        compares the predictions of a TFLite model saved by
+        export_tflite against the keras model's on training windows
+
+        filename: the TFLite model
+        num_windows: number of windows to compare on
+        returns: a dict of the rate at which the argmax pitch, length,
+        and both agree, and the seconds each model took
+        """
+        sequence_len = self.notes_manager.sequence_len
+        num_lengths = self.notes_manager.num_lengths
+
+        available = max(len(self.notes_manager.note_codes) - sequence_len, 1)
+        starts = numpy.random.choice(available, size=min(num_windows, available), replace=False)
+        windows, _ = self.notes_manager.encode_windows(starts)
+
+        keras_step = K.function([self._model.input], [self._model.output])
+        tflite_step = TFLiteStep(filename)
+
+        start = time.perf_counter()
+        expected = numpy.concatenate([keras_step([window[numpy.newaxis]])[0] for window in windows])
+        keras_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        predicted = numpy.concatenate([tflite_step([window[numpy.newaxis]])[0] for window in windows])
+        tflite_seconds = time.perf_counter() - start
+
+        pitches = (numpy.argmax(expected[:, num_lengths:], axis=1) ==
+                   numpy.argmax(predicted[:, num_lengths:], axis=1))
+        lengths = (numpy.argmax(expected[:, :num_lengths], axis=1) ==
+                   numpy.argmax(predicted[:, :num_lengths], axis=1))
+
+        return {"pitch": float(pitches.mean()), "length": float(lengths.mean()),
+                "both": float((pitches & lengths).mean()), "windows": len(windows),
+                "keras_seconds": keras_seconds, "tflite_seconds": tflite_seconds}
+
+
+def __sample_weights__(counts):
+    """
+    returns the sample weights of examples seen the given number of
+    times: proportional to their counts, and averaging one
+    """
+    return (counts * (len(counts) / max(counts.sum(), 1))).astype(numpy.float32)
+
+
+def __vocab_source__(old_vocab, new_vocab):
+    """
+    returns an array of the index in old_vocab of every class
+    of new_vocab, or -1 for classes that are new
+    """
+    old_index = {c: i for i, c in enumerate(old_vocab)}
+    return numpy.array([old_index.get(c, -1) for c in new_vocab], dtype=int)
+
+
+def sample_codes(predictions, temperature=None, top_k=None, rng=None):
+    """
+    Picks one class per row of predictions: the most likely one, or,
+    if a temperature or top_k is given, one sampled from the row's
+    predictions, normalized to sum to one.
+
+    predictions: a (batch, classes) array of non-negative scores
+    temperature: a float >= 0, scales the log of the scores before
+    sampling. 0 picks the most likely class, like not sampling.
+    top_k: an int >= 1, only the top_k highest scores of a row can be picked
+    rng: the numpy Generator to sample with, or a list of one per row
+    so that each row's draws only depend on its own generator. The
+    global numpy random state is used by default.
+    returns: a (batch,) array of class indices
+    """
+    if temperature is not None and temperature < 0:
+        raise ValueError("temperature must not be negative, got {}".format(temperature))
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be at least 1, got {}".format(top_k))
+
+    if temperature == 0 or (temperature is None and top_k is None):
+        return numpy.argmax(predictions, axis=1)
+
+    logits = numpy.log(numpy.maximum(predictions, 1e-12)) / (1. if temperature is None else temperature)
+
+    # leave only the k best classes of each row
+    if top_k is not None and top_k < logits.shape[1]:
+        cutoff = numpy.partition(logits, -top_k, axis=1)[:, -top_k, numpy.newaxis]
+        logits = numpy.where(logits >= cutoff, logits, -numpy.inf)
+
+    probabilities = numpy.exp(logits - logits.max(axis=1, keepdims=True))
+    cumulative = numpy.cumsum(probabilities, axis=1)
+
+    # the first class whose cumulative probability passes a uniform draw
+    if isinstance(rng, list):
+        draws = numpy.array([row_rng.random() for row_rng in rng]) * cumulative[:, -1]
+    else:
+        draws = (rng or numpy.random).random(len(cumulative)) * cumulative[:, -1]
+    return numpy.minimum((cumulative <= draws[:, numpy.newaxis]).sum(axis=1), cumulative.shape[1] - 1)
+
+
+class TFLiteStep:
+    """
+    A forward pass through a TFLite model, called the same way as
+    the backend function predict_step compiles: step([windows])[0]
+    are the predictions. The interpreter is resized when the batch
+    size changes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._interpreter = tf.lite.Interpreter(model_path=filename)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]["index"]
+        self._output = self._interpreter.get_output_details()[0]["index"]
+        self._batch_size = self._interpreter.get_input_details()[0]["shape"][0]
+
+        # an interpreter can only run one batch at a time
+        self._lock = threading.Lock()
+
+    def __call__(self, inputs):
+        windows = numpy.ascontiguousarray(inputs[0], dtype=numpy.float32)
+
+        with self._lock:
+            if len(windows) != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input, windows.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(windows)
+
+            self._interpreter.set_tensor(self._input, windows)
+            self._interpreter.invoke()
+            return [self._interpreter.get_tensor(self._output)]
@@ -2,91 +2,710 @@
 
 from helpers import *
 import pickle
+import hashlib
+import json
+import struct
+import math
+import mido
 import numpy
-from sklearn.preprocessing import MultiLabelBinarizer
+import metrics
+from fractions import Fraction
+from numpy.lib.stride_tricks import as_strided
+from concurrent.futures import ProcessPoolExecutor
 
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+# note corpus file format, see write_corpus
+CORPUS_MAGIC = b"NOTECORP"
+CORPUS_VERSION = 1
+CORPUS_DTYPE = numpy.dtype("<i4")
+
+# how music21 spells the pitch classes of MIDI note numbers
+MIDI_PITCH_NAMES = ["C", "C#", "D", "E-", "E", "F", "F#", "G", "G#", "A", "B-", "B"]
+
 
 class NotesManager:
 
     def __init__(self, file, sequence_len=16):
 
-        self._notes = self.__load_notes__(file)
-        self.pitches, self.lengths = self.__separate_notes__(self._notes)
-        self.num_features = None  # number of unique notes/chords
+        # integer coded notes: column 0 is the pitch code, column 1 the length code
+        self.pitch_vocab, self.length_vocab, self.note_codes = self.__load_notes__(file)
+        self.pitches, self.lengths = self.__separate_notes__(self.note_codes)
+        self.num_features = self.num_lengths + self.num_pitches  # number of unique notes/chords and lengths
         self.sequence_len = sequence_len
 
-        self.one_hot_encoder = MultiLabelBinarizer()  # translates input/output to the NN
+        self._one_hot_encoder = None
+        self._durations = None  # length vocabulary without the "-", see decode
 
         self.training_input = None
         self.training_output = None
 
+        self._shift_tables = {}  # max shift --> table, see shift_table
+
+    @property
+    def one_hot_encoder(self):
+        """
+        translates input/output to the NN. Lengths all start with "-", so
+        they sort before the pitches and take up the first num_lengths
+        classes. Built on first use, so sklearn is only imported if needed.
+        """
+        if self._one_hot_encoder is None:
+            from sklearn.preprocessing import MultiLabelBinarizer
+
+            self._one_hot_encoder = MultiLabelBinarizer(classes=self.length_vocab + self.pitch_vocab)
+            self._one_hot_encoder.fit([])
+
+        return self._one_hot_encoder
+
     @staticmethod
     def __load_notes__(file):
         """
-        loads notes from the given file via pickling
+        loads notes from the given file. A .pickle file of [pitch, length]
+        pairs is encoded in memory, any other file is opened as a note
+        corpus (see write_corpus) without copying the notes into memory.
+        """
+        if file.endswith(".pickle"):
+
+            # grab the notes from the given file
+            with open(file, "rb") as fp:
+                notes = pickle.load(fp)
+
+            return encode_notes(notes)
+
+        return load_corpus(file)
+
+    def __separate_notes__(self, codes):
+        """
+        Separates the given note codes into pitch codes and length codes
         """
-        # grab the notes from the given file
-        with open(file, "rb") as fp:
-            notes = pickle.load(fp)
 
-        return notes
+        self.num_pitches = len(self.pitch_vocab)
+        self.num_lengths = len(self.length_vocab)
 
-    def __separate_notes__(self, notes):
+        return codes[:, 0], codes[:, 1]
+
+    def encode(self, codes):
         """
-        Separates the given notes into pitches and length
+        one-hot encodes the given (n, 2) array of note codes the same
+        way the one_hot_encoder would encode the notes themselves
+
+        codes: an array of [pitch code, length code] rows
+        returns: an (n, num_features) array
         """
+        encoded = numpy.zeros((len(codes), self.num_features), dtype=numpy.float32)
+        rows = numpy.arange(len(codes))
 
-        # separate the pitches and lengths of the notes
-        pitches = []
-        lengths = []
+        encoded[rows, codes[:, 1]] = 1
+        encoded[rows, codes[:, 0] + self.num_lengths] = 1
 
-        # separate the notes from "10.2:.25" --> ["10.2", ".25"]
-        for n in notes:
-            pitches.append(n[0])
-            lengths.append(n[1])
+        return encoded
 
-        self.num_pitches = len(set(pitches))
-        self.num_lengths = len(set(lengths))
+    def decode(self, codes):
+        """
+        translates the given (n, 2) array of note codes back to notes,
+        (pitch, duration) tuples with the "-" taken off the duration
+
+        codes: an array of [pitch code, length code] rows
+        returns: a list of n tuples
+        """
+        if self._durations is None:
+            self._durations = [length[1:] if length.startswith("-") else length for length in self.length_vocab]
+
+        pitch_vocab = self.pitch_vocab
+        durations = self._durations
+
+        return [(pitch_vocab[pitch], durations[length]) for pitch, length in codes.tolist()]
+
+    def shift_table(self, max_shift):
+        """
+        returns a (2 * max_shift + 1, num_pitches) table that maps each
+        pitch code to the code of the same pitch or chord shifted by
+        -max_shift..max_shift semitones (row shift + max_shift), or to
+        -1 where the shifted pitch isn't in the vocabulary. Rests are
+        never shifted.
+
+        max_shift: an int, the largest shift in semitones
+        """
+        if max_shift not in self._shift_tables:
+
+            pitch_index = {p: i for i, p in enumerate(self.pitch_vocab)}
+            table = numpy.full((2 * max_shift + 1, self.num_pitches), -1, dtype=CORPUS_DTYPE)
+
+            for shift in range(-max_shift, max_shift + 1):
+                for code, pitch in enumerate(self.pitch_vocab):
+                    if pitch == "X":
+                        shifted = pitch
+                    else:
+                        shifted = ','.join(str(int(n) + shift) for n in pitch.split(','))
+                    table[shift + max_shift, code] = pitch_index.get(shifted, -1)
+
+            self._shift_tables[max_shift] = table
+
+        return self._shift_tables[max_shift]
+
+    def random_shifts(self, starts, max_shift):
+        """
+        picks a random shift of -max_shift..max_shift semitones for each
+        of the windows that start at the given note indices, among the
+        shifts that keep every pitch of the window in the vocabulary
+
+        starts: an array of note indices, each < len(note_codes) - sequence_len
+        max_shift: an int, the largest shift in semitones
+        returns: an array of shifts, one per window
+        """
+        positions = numpy.asarray(starts)[:, None] + numpy.arange(self.sequence_len + 1)
+        table = self.shift_table(max_shift)
+
+        # (shifts, windows) mask of the shifts that stay in the vocabulary
+        valid = (table[:, self.note_codes[positions, 0]] >= 0).all(axis=2)
+
+        # not shifting is always valid, so every window has a choice
+        choice = numpy.argmax(numpy.random.random_sample(valid.shape) * valid, axis=0)
+
+        return choice - max_shift
+
+    def encode_windows(self, starts, shifts=None):
+        """
+        one-hot encodes the windows that start at the given note
+        indices, along with the note that follows each window. Only
+        the requested windows are encoded.
+
+        starts: an array of note indices, each < len(note_codes) - sequence_len
+        shifts: an optional array of semitones to shift each window by.
+        A window with a pitch that has no shifted counterpart in the
+        vocabulary is left unshifted.
+        returns: (len(starts), sequence_len, num_features) inputs and
+        (len(starts), num_features) outputs
+        """
+        codes = self.__window_codes__(starts, shifts)
+
+        encoded = numpy.zeros(codes.shape[:2] + (self.num_features,), dtype=numpy.float32)
+        windows, steps = numpy.indices(codes.shape[:2])
+
+        encoded[windows, steps, codes[..., 1]] = 1
+        encoded[windows, steps, codes[..., 0] + self.num_lengths] = 1
+
+        return encoded[:, :self.sequence_len], encoded[:, self.sequence_len]
+
+    def code_windows(self, starts, shifts=None):
+        """
+        the windows that start at the given note indices, and the note
+        that follows each, as integer pitch and length codes rather than
+        one-hot encoded, for networks that embed their inputs
+
+        starts, shifts: as in encode_windows
+        returns: [(len(starts), sequence_len) pitch codes, (len(starts), sequence_len)
+        length codes] inputs and [(len(starts),) pitch codes, (len(starts),) length codes] outputs
+        """
+        codes = self.__window_codes__(starts, shifts)
+        inputs, outputs = codes[:, :self.sequence_len], codes[:, self.sequence_len]
+
+        return [inputs[..., 0], inputs[..., 1]], [outputs[:, 0], outputs[:, 1]]
+
+    def __window_codes__(self, starts, shifts=None):
+        """
+        returns the (len(starts), sequence_len + 1, 2) note codes of the
+        windows that start at the given note indices and the note that
+        follows each, shifted as in encode_windows
+        """
+        positions = numpy.asarray(starts)[:, None] + numpy.arange(self.sequence_len + 1)
+        codes = self.note_codes[positions]
 
-        return pitches, lengths
+        if shifts is not None:
+            shifts = numpy.asarray(shifts)
+            max_shift = int(numpy.abs(shifts).max()) if len(shifts) else 0
+
+            pitch_codes = self.shift_table(max_shift)[(shifts + max_shift)[:, None], codes[..., 0]]
+            in_vocab = (pitch_codes >= 0).all(axis=1)
+
+            codes = codes.copy()
+            codes[in_vocab, :, 0] = pitch_codes[in_vocab]
+
+        return codes
 
     def create_sequences(self):
         """
         creates input and output sequences to pass to the neural network
         If the sequences have already been created, return the sequences.
+
+        The input windows are read-only strided views over a single
+        array of encoded notes, so window i and window i+1 share memory
+        rather than each holding a copy of sequence_len notes.
         """
 
         # if data is already available, return the given data instead of calculating it again
-        if self.training_input and self.training_output:
+        if self.training_input is not None and self.training_output is not None:
             return self.training_input, self.training_output
 
-        training_input = []
-        training_output = []
+        with metrics.timer("create_sequences"):
+            notes = self.encode(self.note_codes)
+            num_windows = max(len(notes) - self.sequence_len, 0)
 
-        # translator for encoding/decoding input and output to the NN
-        notes = self.one_hot_encoder.fit_transform(self._notes)
+            # window i starts at note i, so consecutive windows are one note apart
+            note_stride, feature_stride = notes.strides
+            training_input = as_strided(notes, shape=(num_windows, self.sequence_len, self.num_features),
+                                        strides=(note_stride, note_stride, feature_stride), writeable=False)
+            training_output = notes[self.sequence_len:]
 
-        for i in range(len(notes) - self.sequence_len):
+        metrics.increment("windows_created", num_windows)
 
-            training_input.append([x for x in notes[i:i+self.sequence_len]])
-            training_output.append(notes[i+self.sequence_len])
-
-        # transform to numpy array
-        training_input = numpy.asarray(training_input)
-        training_output = numpy.asarray(training_output)
-
-        # save the training input/output and encoder to the class
-        self.num_features = len(self.one_hot_encoder.classes_)
+        # save the training input/output to the class
         self.training_input = training_input
         self.training_output = training_output
 
         return training_input, training_output
 
+    def unique_windows(self, starts=None):
+        """
+        finds the distinct training examples among the windows that
+        start at the given note indices: windows holding the same notes
+        followed by the same note are the same example, however many
+        times a repeated chorus or riff produces them. Windows are
+        compared by their note codes, which are the same exactly when
+        their encodings are.
+
+        starts: the note indices of the windows, every window by default
+        returns: the start of the first window of every distinct example,
+        in corpus order, and the number of windows with that example
+        """
+        if starts is None:
+            starts = numpy.arange(max(len(self.note_codes) - self.sequence_len, 0))
+        starts = numpy.asarray(starts)
+
+        # each example as one row of bytes, so numpy.unique compares whole examples at once
+        positions = starts[:, None] + numpy.arange(self.sequence_len + 1)
+        rows = numpy.ascontiguousarray(self.note_codes[positions]).reshape(len(starts), -1)
+        examples = rows.view(numpy.dtype((numpy.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+        _, first, counts = numpy.unique(examples, return_index=True, return_counts=True)
+        order = numpy.argsort(first)
+
+        metrics.increment("windows_deduplicated", len(starts) - len(first))
+
+        return starts[first[order]], counts[order]
+
+    def create_code_sequences(self):
+        """
+        creates input and output sequences of integer note codes, for
+        networks that embed their inputs: (num_windows, sequence_len, 2)
+        windows of [pitch code, length code] rows and the (num_windows, 2)
+        code of the note after each. Like create_sequences, the windows
+        are read-only strided views, here straight over the note codes,
+        so nothing is copied.
+        """
+        num_windows = max(len(self.note_codes) - self.sequence_len, 0)
+
+        note_stride, column_stride = self.note_codes.strides
+        training_input = as_strided(self.note_codes, shape=(num_windows, self.sequence_len, 2),
+                                    strides=(note_stride, note_stride, column_stride), writeable=False)
+        training_output = self.note_codes[self.sequence_len:]
+
+        metrics.increment("windows_created", num_windows)
+
+        return training_input, training_output
+
+
+def encode_notes(notes, pitch_vocab=(), length_vocab=()):
+    """
+    integer codes a list of [pitch, length] pairs
+
+    notes: a list of notes, e.g. [["60,64,67", "-0.5"], ["62", "-1.0"]]
+    pitch_vocab, length_vocab: optional vocabularies to extend. Their
+    classes keep their codes, and classes new to them are added after
+    them, sorted.
+    returns: the pitch vocabulary, the length vocabulary, and an (n, 2)
+    int32 array of [pitch code, length code] rows
+    """
+
+    pitch_vocab = list(pitch_vocab) + sorted(set(n[0] for n in notes) - set(pitch_vocab))
+    length_vocab = list(length_vocab) + sorted(set(n[1] for n in notes) - set(length_vocab))
+
+    pitch_index = {p: i for i, p in enumerate(pitch_vocab)}
+    length_index = {l: i for i, l in enumerate(length_vocab)}
 
-def parse_notes(fp_songs, fp_out, intro_split=24, outro_split=24):
+    codes = numpy.empty((len(notes), 2), dtype=CORPUS_DTYPE)
+    for i, n in enumerate(notes):
+        codes[i, 0] = pitch_index[n[0]]
+        codes[i, 1] = length_index[n[1]]
+
+    return pitch_vocab, length_vocab, codes
+
+
+def write_corpus(notes, file, keep_vocab=False):
+    """
+    writes notes as a note corpus, a compact binary file that can
+    be memory mapped. The file holds:
+    - the magic bytes and format version
+    - a JSON header with the pitch and length vocabularies and the
+    number of notes, padded to 16 bytes
+    - the notes as little-endian int32 [pitch code, length code] rows
+
+    notes: a list of [pitch, length] pairs
+    file: the file path to write the corpus to
+    keep_vocab: a Bool, set to True to keep the vocabularies of the
+    corpus already at file, if there is one, in their order, adding
+    only the classes new to them (as append_corpus does). The feature
+    columns of networks trained on that corpus then stay valid.
+    """
+    pitch_vocab, length_vocab = (), ()
+
+    if keep_vocab and os.path.exists(file):
+        try:
+            pitch_vocab, length_vocab, _ = load_corpus(file)
+        except ValueError:
+            pass
+
+    write_codes(*encode_notes(notes, pitch_vocab, length_vocab), file)
+
+
+def write_codes(pitch_vocab, length_vocab, codes, file):
+    """
+    writes notes that are already integer coded as a note corpus
+
+    pitch_vocab: the pitch vocabulary
+    length_vocab: the length vocabulary
+    codes: an (n, 2) array of [pitch code, length code] rows
+    file: the file path to write the corpus to
+    """
+    codes = numpy.ascontiguousarray(codes, dtype=CORPUS_DTYPE)
+
+    header = json.dumps({"pitches": list(pitch_vocab), "lengths": list(length_vocab),
+                         "count": len(codes)}).encode("utf-8")
+    offset = len(CORPUS_MAGIC) + 8 + len(header)
+    header += b" " * (-offset % 16)
+
+    # write next to the file and then replace it, so a corpus that is
+    # memory mapped while it is rewritten keeps its old contents
+    with open(file + ".tmp", "wb") as fw:
+        fw.write(CORPUS_MAGIC)
+        fw.write(struct.pack("<II", CORPUS_VERSION, len(header)))
+        fw.write(header)
+        fw.write(codes.tobytes())
+    os.replace(file + ".tmp", file)
+
+
+def load_corpus(file):
+    """
+    opens a note corpus written by write_corpus. The notes are memory
+    mapped, read only, rather than read into memory.
+
+    file: the file path of the corpus
+    returns: the pitch vocabulary, the length vocabulary, and an
+    (n, 2) array of [pitch code, length code] rows
+    """
+
+    with open(file, "rb") as fp:
+        magic = fp.read(len(CORPUS_MAGIC))
+        if magic != CORPUS_MAGIC:
+            raise ValueError("{} is not a note corpus".format(file))
+
+        version, header_len = struct.unpack("<II", fp.read(8))
+        if version != CORPUS_VERSION:
+            raise ValueError("unsupported note corpus version {}".format(version))
+
+        header = json.loads(fp.read(header_len).decode("utf-8"))
+
+    count = header["count"]
+
+    # an empty file region can't be memory mapped
+    if count == 0:
+        codes = numpy.zeros((0, 2), dtype=CORPUS_DTYPE)
+    else:
+        codes = numpy.memmap(file, dtype=CORPUS_DTYPE, mode="r", shape=(count, 2),
+                             offset=len(CORPUS_MAGIC) + 8 + header_len)
+
+    return header["pitches"], header["lengths"], codes
+
+
+def append_corpus(notes, file):
+    """
+    appends notes to a note corpus. The vocabularies only grow: pitches
+    and lengths that are new to the corpus are added after the existing
+    ones, so the codes of the notes already in it don't change.
+
+    notes: a list of [pitch, length] pairs
+    file: the file path of the corpus. If it doesn't exist it is made
+    from the pickle of the same name, as convert_pickles does, so the
+    notes parsed before are kept, or made from the notes alone if
+    there is no pickle either.
+    returns: the number of notes the corpus held before
+    """
+    if not os.path.exists(file):
+        pickle_fp = os.path.splitext(file)[0] + ".pickle"
+        if not os.path.exists(pickle_fp):
+            write_corpus(notes, file)
+            return 0
+
+        with open(pickle_fp, "rb") as fp:
+            write_corpus(pickle.load(fp), file)
+
+    pitch_vocab, length_vocab, codes = load_corpus(file)
+    pitch_vocab, length_vocab, new_codes = encode_notes(notes, pitch_vocab, length_vocab)
+
+    write_codes(pitch_vocab, length_vocab, numpy.concatenate([codes, new_codes]), file)
+
+    return len(codes)
+
+
+def append_notes(files, fp_out, intro_split=24, outro_split=24, workers=1, backend="music21"):
+    """
+    parses only the given songs and appends their notes to the intro,
+    middle, and outro note corpora in fp_out (see append_corpus), so
+    adding songs to a corpus costs only the parsing of the new songs.
+    The songs are split into sections as in parse_notes.
+
+    files: a list of the MIDI files of the new songs
+    fp_out: filepath of the parsed_notes folder
+    the remaining arguments are as in parse_notes
+    returns: a dict of section --> number of notes the section held
+    before, the index of the first new note
+    """
+    if backend == "music21":
+        parse = parse_song
+    elif backend == "mido":
+        parse = parse_song_mido
+    else:
+        raise ValueError("unknown parser backend {}".format(backend))
+
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(parse, files))
+    else:
+        parsed = [parse(file) for file in files]
+
+    metrics.increment("songs_parsed", len(files))
+
+    sections = {"intro": [], "middle": [], "outro": []}
+
+    for notes in parsed:
+
+        if notes is None:
+            continue
+
+        last_index = len(notes) - 1
+
+        # split the song notes
+        sections["intro"].extend(notes[:intro_split])
+        sections["middle"].extend(notes[intro_split:last_index-outro_split])
+        sections["outro"].extend(notes[last_index - outro_split:])
+
+    return {section: append_corpus(notes, "{}/{}.corpus".format(fp_out, section))
+            for section, notes in sections.items()}
+
+
+def convert_pickles(fp_notes):
+    """
+    converts the intro, middle, and outro pickles in the given
+    parsed_notes folder to note corpora next to them,
+    e.g. intro.pickle --> intro.corpus
+
+    fp_notes: filepath of the parsed_notes folder
+    """
+
+    for section in ("intro", "middle", "outro"):
+        with open("{}/{}.pickle".format(fp_notes, section), "rb") as fp:
+            notes = pickle.load(fp)
+
+        write_corpus(notes, "{}/{}.corpus".format(fp_notes, section))
+
+
+def parse_song(file):
+    """
+    parses a single MIDI file into a list of [note, duration] pairs,
+    e.g. [["60,64,67", "-0.5"], ["62", "-1.0"]]
+
+    file: path to the MIDI file
+    returns: a list of notes, or None if the file could not be parsed
+    """
+
+    import music21 as m21
+
+    song_notes = []
+
+    try:
+        song = m21.converter.parse(file)
+    except:
+        print("could not parse file")
+        return None
+
+    notes_to_parse = song.flat.notes
+
+    for element in notes_to_parse:
+        duration = element.duration.quarterLength
+        note = None
+        # find out if the element is a rest, note, or chord
+        if isinstance(element, m21.note.Rest):
+
+            note = "X"
+        elif isinstance(element, m21.note.Note):
+            note = (str(convert_note(str(element.pitch))))
+        elif isinstance(element, m21.chord.Chord):
+
+            note = ','.join(str(convert_note(str(n.pitch))) for n in element)
+        else:
+            continue
+
+        # append the note and its duration to the list
+        song_notes.append([note, "-" + str(duration)])
+
+    return song_notes
+
+
+def parse_song_mido(file):
+    """
+    parses a single MIDI file into a list of [note, duration] pairs by
+    reading its note events directly with mido. This gives the same
+    notes as parse_song, which builds a full music21 score, at a
+    fraction of the cost. The steps follow music21's MIDI import:
+    - each note on is paired with the next event of the same pitch
+    and channel
+    - notes starting within 1/16th of a quarter of each other, and
+    ending within it, are grouped into chords
+    - offsets and durations are quantized to the nearest 1/4 or 1/3
+    of a quarter
+
+    Files mido can't read as they are, e.g. with truncated tracks or
+    out of range data bytes, are handed to parse_song instead, since
+    music21 recovers what it can from them.
+
+    file: path to the MIDI file
+    returns: a list of notes, or None if the file could not be parsed
+    """
+
+    try:
+        midi_file = mido.MidiFile(file)
+    except Exception:
+        metrics.increment("mido_fallbacks")
+        return parse_song(file)
+
+    ticks_per_quarter = midi_file.ticks_per_beat
+    tolerance = ticks_per_quarter / 16
+    elements = []
+
+    for track_index, track in enumerate(midi_file.tracks):
+
+        # absolute tick of each note event
+        events = []
+        tick = 0
+        for message in track:
+            tick += message.time
+            if message.type == "note_on" or message.type == "note_off":
+                events.append((tick, message))
+
+        if not any(message.type == "note_on" for _, message in events):
+            continue
+
+        # pair each note on with the next event of the same pitch and channel
+        by_key = {}
+        for i, (_, message) in enumerate(events):
+            by_key.setdefault((message.channel, message.note), []).append(i)
+
+        pairs = []
+        for indices in by_key.values():
+            k = 0
+            while k < len(indices):
+                message = events[indices[k]][1]
+                if message.type == "note_on" and message.velocity > 0 and k + 1 < len(indices):
+                    pairs.append((indices[k], events[indices[k + 1]][0]))
+                    k += 2
+                else:
+                    k += 1
+
+        pairs.sort()
+        notes = [(events[i][0], tick_off, events[i][1].note) for i, tick_off in pairs]
+
+        # group notes that start and end together into chords
+        gathered = set()
+        for i in range(len(notes)):
+
+            if i in gathered:
+                continue
+
+            tick_on, tick_off, _ = notes[i]
+            group = [notes[i]]
+
+            for j in range(i + 1, len(notes)):
+                if abs(notes[j][0] - tick_on) > tolerance:
+                    break
+                if abs(notes[j][1] - tick_off) <= tolerance:
+                    group.append(notes[j])
+                    gathered.add(j)
+
+            # a chord lasts from its last onset to the end of its first note
+            ticks = group[0][1] - group[-1][0]
+            duration = float(ticks) / ticks_per_quarter if ticks != 0 else 1.0
+
+            offset = __quantize__(tick_on / float(ticks_per_quarter))
+            note = ','.join(str(__midi_note_code__(n[2])) for n in group)
+
+            elements.append((offset, track_index, i, note, "-" + str(__quantize__(max(duration, 0.0)))))
+
+    # order the notes of every track by offset, as in a flattened score
+    elements.sort(key=lambda e: e[:3])
+
+    return [[e[3], e[4]] for e in elements]
+
+
+def __midi_note_code__(number):
+    """
+    converts a MIDI note number to the number convert_note gives
+    the pitch music21 spells for it
+    """
+    return convert_note("{}{}".format(MIDI_PITCH_NAMES[number % 12], number // 12 - 1))
+
+
+def __quantize__(quarter_length):
+    """
+    quantizes a quarter length to the nearest 1/4 or 1/3 of a quarter,
+    returning a float, or a Fraction if it isn't exact as a float
+    """
+
+    matches = []
+    for divisor in (4, 3):
+        unit = 1.0 / divisor
+        low = unit * math.floor(quarter_length / unit)
+        high = low + unit
+
+        if quarter_length <= low + unit / 2.0:
+            matches.append((round(quarter_length - low, 7), low))
+        else:
+            matches.append((round(high - quarter_length, 7), high))
+
+    quarter_length = min(matches)[1]
+
+    # thirds can't be represented exactly as floats
+    if quarter_length.as_integer_ratio()[1] > 65535:
+        fraction = Fraction(quarter_length).limit_denominator(65535)
+        if fraction.denominator & (fraction.denominator - 1):
+            return fraction
+        return float(fraction)
+
+    return quarter_length
+
+
+def __file_hash__(file):
+    """
+    returns the sha1 hex digest of the contents of the given file
+    """
+    with open(file, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def __load_cache__(cache_fp):
+    """
+    loads the per-file note cache, or an empty cache if there is none
+    """
+    try:
+        with open(cache_fp, "rb") as fp:
+            return pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+@metrics.timed("parse_notes")
+def parse_notes(fp_songs, fp_out, intro_split=24, outro_split=24, workers=1, use_cache=True,
+                backend="music21"):
     """
     fp_songs: path to the folder of songs to parse notes from
     fp_out: filepath of the folder to save the notes
@@ -94,48 +713,93 @@ def parse_notes(fp_songs, fp_out, intro_split=24, outro_split=24):
     song for the intro folder
     outro_split: number of notes to take from the end of the song
     for the outro folder
+    workers: number of processes used to parse songs concurrently
+    use_cache: if True, the notes of each song are cached in
+    fp_out/notes_cache.pickle, keyed by path, size/mtime, and content
+    hash, along with the backend that parsed them, and unchanged songs
+    are not parsed again by the same backend
+    backend: "music21" to parse songs into music21 scores, or "mido"
+    to read their note events directly (see parse_song_mido)
     """
 
+    if backend == "music21":
+        parse = parse_song
+    elif backend == "mido":
+        parse = parse_song_mido
+    else:
+        raise ValueError("unknown parser backend {}".format(backend))
+
     intro_notes = []
     middle_notes = []
     outro_notes = []
 
-    for file in glob.glob(fp_songs):
+    files = glob.glob(fp_songs)
 
-        song_notes = []
+    cache_fp = "{}/notes_cache.pickle".format(fp_out)
+    cache = __load_cache__(cache_fp) if use_cache else {}
+    song_notes = {}
+    to_parse = []
 
-        try:
-            song = m21.converter.parse(file)
-        except:
-            print("could not parse file")
+    # reuse the cached notes of any song that hasn't changed
+    for file in files:
+        stat = os.stat(file)
+        entry = cache.get(file)
+
+        # notes parsed by the other backend aren't reused
+        if entry and entry.get("backend") != backend:
+            entry = None
+
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            song_notes[file] = entry["notes"]
             continue
 
-        notes_to_parse = song.flat.notes
+        # a touched file whose contents are the same doesn't need to be parsed
+        digest = __file_hash__(file)
+        if entry and entry["hash"] == digest:
+            entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+            song_notes[file] = entry["notes"]
+            continue
 
-        for element in notes_to_parse:
-            duration = element.duration.quarterLength
-            note = None
-            # find out if the element is a rest, note, or chord
-            if isinstance(element, m21.note.Rest):
+        cache[file] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": digest, "backend": backend,
+                       "notes": None}
+        to_parse.append(file)
 
-                note = "X"
-            elif isinstance(element, m21.note.Note):
-                note = (str(convert_note(str(element.pitch))))
-            elif isinstance(element, m21.chord.Chord):
+    # parse the new and changed songs, in parallel if requested
+    if workers > 1 and len(to_parse) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(parse, to_parse))
+    else:
+        parsed = [parse(file) for file in to_parse]
 
-                note = ','.join(str(convert_note(str(n.pitch))) for n in element)
-            else:
-                continue
+    metrics.increment("songs_parsed", len(to_parse))
+    metrics.increment("songs_cached", len(files) - len(to_parse))
 
-            # append the note and its duration to the list
-            song_notes.append([note, "-" + str(duration)])
+    for file, notes in zip(to_parse, parsed):
+        if notes is None:
+            del cache[file]
+            continue
+        cache[file]["notes"] = notes
+        song_notes[file] = notes
+
+    # forget the songs that are no longer in the folder
+    for file in list(cache):
+        if file not in song_notes:
+            del cache[file]
+
+    for file in files:
 
-        last_index = len(song_notes) - 1
+        if file not in song_notes:
+            continue
+
+        notes = song_notes[file]
+        last_index = len(notes) - 1
 
         # split the song notes
-        intro_notes.extend(song_notes[:intro_split])
-        middle_notes.extend(song_notes[intro_split:last_index-outro_split])
-        outro_notes.extend(song_notes[last_index - outro_split:])
+        intro_notes.extend(notes[:intro_split])
+        middle_notes.extend(notes[intro_split:last_index-outro_split])
+        outro_notes.extend(notes[last_index - outro_split:])
+
+    metrics.increment("notes_parsed", len(intro_notes) + len(middle_notes) + len(outro_notes))
 
     # file paths and names for the parsed notes
     intro_fp = "{}/intro.pickle".format(fp_out)
@@ -150,4 +814,15 @@ def parse_notes(fp_songs, fp_out, intro_split=24, outro_split=24):
         pickle.dump(middle_notes, fw)
 
     with open(outro_fp, "wb") as fw:
-        pickle.dump(outro_notes, fw)
\ No newline at end of file
+        pickle.dump(outro_notes, fw)
+
+    # the same notes as memory mappable note corpora. A corpus that
+    # already exists keeps its vocabulary order, which trained networks
+    # and corpora grown by append_notes depend on
+    write_corpus(intro_notes, "{}/intro.corpus".format(fp_out), keep_vocab=True)
+    write_corpus(middle_notes, "{}/middle.corpus".format(fp_out), keep_vocab=True)
+    write_corpus(outro_notes, "{}/outro.corpus".format(fp_out), keep_vocab=True)
+
+    if use_cache:
+        with open(cache_fp, "wb") as fw:
+            pickle.dump(cache, fw)
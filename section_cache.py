@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+"""
+An on-disk cache of generated sections. A section generated from a
+given seed only depends on the network that generated it, the seed,
+and how it was sampled, so it is stored as its note codes under a
+key of those and read back instead of running the network again.
+
+Generation is autoregressive, so the first n notes generated from a
+seed are the same however many notes follow them: an entry holds the
+longest section generated for its key and serves any shorter length.
+
+Entries are .npy files in one folder; the least recently used are
+deleted once there are more than max_entries of them.
+
+Example:
+    cache = SectionCache("rock/bass/nn_cache")
+    key = cache.key(rnn.fingerprint(), seed=(7, 0))
+    codes = cache.get(key, 32)
+    if codes is None:
+        ...
+        cache.put(key, codes)
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy
+import metrics
+
+
+class SectionCache:
+
+    def __init__(self, path, max_entries=256):
+        """
+        path: the folder to keep the entries in, made when the first is written
+        max_entries: an int, the most sections kept
+        """
+        self.path = path
+        self.max_entries = max_entries
+
+        # the sections of a song are generated on several threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(fingerprint, seed, temperature=None, top_k=None):
+        """
+        returns the key of a section
+
+        fingerprint: the hash of the network, see MusicRNN.fingerprint
+        seed: an int or sequence of ints, the section's seed
+        temperature, top_k: how the section was sampled, see nn.sample_codes
+        """
+        seed = [int(s) for s in numpy.atleast_1d(seed)]
+        return hashlib.sha256(json.dumps([fingerprint, seed, temperature, top_k]).encode("utf-8")).hexdigest()
+
+    def __entry__(self, key):
+        return "{}/{}.npy".format(self.path, key)
+
+    def get(self, key, num_notes):
+        """
+        returns the (num_notes, 2) note codes stored under key, or None
+        if there are none or fewer than num_notes of them
+        """
+        entry = self.__entry__(key)
+
+        with self._lock:
+            try:
+                codes = numpy.load(entry)
+            except (IOError, OSError, ValueError):
+                codes = None
+
+            if codes is None or len(codes) < num_notes:
+                metrics.increment("section_cache_misses")
+                return None
+
+            # mark the entry as just used
+            os.utime(entry)
+
+        metrics.increment("section_cache_hits")
+        return codes[:num_notes]
+
+    def put(self, key, codes):
+        """
+        stores the (n, 2) note codes of a section under key, unless a
+        longer section already is, and evicts the least recently used
+        entries if there are too many
+        """
+        entry = self.__entry__(key)
+
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+
+            try:
+                if len(numpy.load(entry, mmap_mode="r")) >= len(codes):
+                    return
+            except (IOError, OSError, ValueError):
+                pass
+
+            # write next to the entry and then replace it, so a reader never sees half an entry
+            with open(entry + ".tmp", "wb") as fw:
+                numpy.save(fw, numpy.asarray(codes, dtype=numpy.int32))
+            os.replace(entry + ".tmp", entry)
+
+            self.__evict__()
+
+    def __evict__(self):
+        """
+        deletes the least recently used entries past max_entries
+        """
+        entries = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".npy")]
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+
+        metrics.increment("section_cache_evictions", len(entries) - self.max_entries)
+
+    def clear(self):
+        """
+        deletes every entry
+        """
+        with self._lock:
+            if not os.path.isdir(self.path):
+                return
+            for name in os.listdir(self.path):
+                if name.endswith(".npy"):
+                    os.remove(os.path.join(self.path, name))
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+"""
+Song generation server. Keeps the intro, middle, and outro
+MusicRNNs of each genre/instrument loaded between requests,
+so a request only pays for generating its song. Requests
+for the same genre/instrument that arrive together are
+generated as one batch, each step one forward pass over
+all of their songs.
+
+Example:
+    python3 server.py -p 5000 -m rock -i bass
+    curl -o song.mid "localhost:5000/generate?music=rock&instrument=bass"
+"""
+
+import sys
+import queue
+import getopt
+import threading
+import metrics
+import generator as gen
+import song_creator as sc
+from concurrent.futures import Future
+from flask import Flask, Response, jsonify, request
+
+# the section lengths a request can set, and their defaults (as in create_song)
+SECTION_LENGTHS = {"intro_len": 32, "verse_len": 52, "chorus_len": 64, "bridge_len": 48, "outro_len": 32}
+
+# most notes a single section may be asked for
+MAX_SECTION_LEN = 1024
+
+
+class SongBatcher:
+    """
+    Generates songs for one genre/instrument on a background
+    thread. Requests are queued; the thread takes every request
+    that arrives within max_wait seconds of the first one (up to
+    max_batch of them) and generates their songs together.
+    """
+
+    def __init__(self, song_creator, max_batch=32, max_wait=.02):
+        """
+        song_creator: a SongCreator with its networks loaded
+        max_batch: an int, the most songs generated in one batch
+        max_wait: a float, seconds to wait for more requests
+        after the first one of a batch arrives
+        """
+        self.song_creator = song_creator
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self.__run__, daemon=True)
+        self._thread.start()
+
+    def submit(self, options):
+        """
+        Queues a song to be generated
+
+        options: a dict of section lengths (see SECTION_LENGTHS), the
+        temperature and top_k to sample with, and the song's seed
+        returns: a Future of the song's notes
+        """
+        future = Future()
+        self._requests.put((options, future))
+        return future
+
+    def __next_batch__(self):
+        """
+        returns the requests of the next batch, waiting
+        for the first one
+        """
+        batch = [self._requests.get()]
+
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(self._requests.get(timeout=self.max_wait))
+        except queue.Empty:
+            pass
+
+        return batch
+
+    def __run__(self):
+        while True:
+            batch = self.__next_batch__()
+            metrics.increment("server_batches")
+            metrics.increment("server_songs", len(batch))
+
+            # songs can only share a batch if their sections are the same length and they are sampled
+            # the same way. Each song keeps its own seed.
+            groups = {}
+            for options, future in batch:
+                options = dict(options)
+                seed = options.pop("seed", None)
+                groups.setdefault(tuple(sorted(options.items())), []).append((seed, future))
+
+            for options, requests in groups.items():
+                seeds, futures = zip(*requests)
+                try:
+                    songs = self.song_creator.generate_songs(len(futures), seed=list(seeds), **dict(options))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+
+                for future, song in zip(futures, songs):
+                    future.set_result(song)
+
+
+class ModelServer:
+    """
+    Loads a SongCreator per genre/instrument the first time it is
+    asked for, and keeps it, with its SongBatcher, for later requests.
+    Each model is loaded once, by the first request for it; requests
+    for it that arrive meanwhile wait for that load.
+    """
+
+    def __init__(self, max_batch=32, max_wait=.02):
+        """
+        max_batch, max_wait: as in SongBatcher
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        # (genre, instrument) --> Future of its SongBatcher
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def batcher(self, genre, instrument):
+        """
+        returns the SongBatcher of the given genre/instrument,
+        loading its networks the first time
+        """
+        key = (genre, instrument)
+
+        # the lock is only held to find or claim the model's future, so loading
+        # one model doesn't hold up requests for the models already loaded
+        with self._lock:
+            future = self._batchers.get(key)
+            loading = future is None
+            if loading:
+                future = self._batchers[key] = Future()
+
+        if loading:
+            try:
+                with metrics.timer("server_load_model"):
+                    song_creator = sc.SongCreator(genre, instrument, parsed=True)
+                    song_creator.load_nn_weights()
+                future.set_result(SongBatcher(song_creator, max_batch=self.max_batch, max_wait=self.max_wait))
+
+            # forget the failed load, so a later request tries again
+            except Exception as e:
+                with self._lock:
+                    del self._batchers[key]
+                future.set_exception(e)
+
+        return future.result()
+
+    def loaded(self):
+        """
+        returns the genre/instrument pairs that are loaded
+        """
+        with self._lock:
+            futures = list(self._batchers.items())
+
+        return ["{}/{}".format(genre, instrument) for (genre, instrument), future in futures
+                if future.done() and future.exception() is None]
+
+
+def create_app(model_server):
+    """
+    Creates the Flask app serving songs from the given ModelServer
+
+    routes:
+    -/generate?music=<genre>&instrument=<instrument>[&intro_len=<n>...][&temperature=<t>][&top_k=<k>][&seed=<n>]
+    returns a MIDI file. A song with a seed is always the same, and
+    its sections are served from the section cache after the first time
+    -/models lists the loaded genre/instruments
+    -/metrics returns the recorded metrics in the Prometheus text format
+    """
+    app = Flask(__name__)
+
+    @app.route("/generate")
+    def generate():
+        genre = request.args.get("music")
+        instrument = request.args.get("instrument")
+        if not genre or not instrument:
+            return jsonify(error="music and instrument are required"), 400
+
+        try:
+            options = {name: int(request.args.get(name, default)) for name, default in SECTION_LENGTHS.items()}
+        except ValueError:
+            return jsonify(error="section lengths must be integers"), 400
+
+        if not all(0 < length <= MAX_SECTION_LEN for length in options.values()):
+            return jsonify(error="section lengths must be between 1 and {}".format(MAX_SECTION_LEN)), 400
+
+        # songs are sampled instead of taking the most likely notes if these are given
+        try:
+            temperature = request.args.get("temperature")
+            top_k = request.args.get("top_k")
+            options["temperature"] = float(temperature) if temperature else None
+            options["top_k"] = int(top_k) if top_k else None
+        except ValueError:
+            return jsonify(error="temperature and top_k must be numbers"), 400
+
+        if options["temperature"] is not None and options["temperature"] < 0:
+            return jsonify(error="temperature must not be negative"), 400
+        if options["top_k"] is not None and options["top_k"] < 1:
+            return jsonify(error="top_k must be at least 1"), 400
+
+        try:
+            seed = request.args.get("seed")
+            options["seed"] = int(seed) if seed else None
+        except ValueError:
+            return jsonify(error="seed must be an integer"), 400
+
+        if options["seed"] is not None and options["seed"] < 0:
+            return jsonify(error="seed must not be negative"), 400
+
+        try:
+            batcher = model_server.batcher(genre, instrument)
+        except (IOError, OSError) as e:
+            return jsonify(error="could not load {}/{}: {}".format(genre, instrument, e)), 404
+
+        with metrics.timer("server_request"):
+            notes = batcher.submit(options).result()
+            midi = gen.write_to_midi(notes, None, backend="mido")
+
+        return Response(midi, mimetype="audio/midi",
+                        headers={"Content-Disposition": "attachment; filename={}.mid".format(genre)})
+
+    @app.route("/models")
+    def models():
+        return jsonify(models=model_server.loaded())
+
+    @app.route("/metrics")
+    def export_metrics():
+        return Response(metrics.to_prometheus(), mimetype="text/plain")
+
+    return app
+
+
+def main(argv):
+
+    helpstring = ("server.py -p <port> -m <music genre> -i <instrument> --host <host> --max-batch <n> "
+                  "--max-wait <seconds> --metrics\n"
+                  "-p: port to listen on, 5000 by default\n"
+                  "-m, -i: a genre and instrument to load before serving, others are loaded when first asked for\n"
+                  "--host: address to listen on, 127.0.0.1 by default\n"
+                  "--max-batch: most songs generated in one batch\n"
+                  "--max-wait: seconds to wait for more requests to batch with the first one\n"
+                  "--metrics: record metrics and serve them at /metrics")
+
+    port = 5000
+    host = "127.0.0.1"
+    music = None
+    instrument = None
+    max_batch = 32
+    max_wait = .02
+
+    try:
+        opts, args = getopt.getopt(argv, "hp:m:i:", ["port=", "music=", "instrument=", "host=", "max-batch=",
+                                                     "max-wait=", "metrics"])
+    except getopt.GetoptError:
+        print(helpstring)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(helpstring)
+            sys.exit()
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-m", "--music"):
+            music = arg
+        elif opt in ("-i", "--instrument"):
+            instrument = arg
+        elif opt == "--host":
+            host = arg
+        elif opt == "--max-batch":
+            max_batch = int(arg)
+        elif opt == "--max-wait":
+            max_wait = float(arg)
+        elif opt == "--metrics":
+            metrics.enable()
+
+    model_server = ModelServer(max_batch=max_batch, max_wait=max_wait)
+
+    # load the given model before taking requests
+    if music and instrument:
+        model_server.batcher(music, instrument)
+
+    create_app(model_server).run(host=host, port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,8 +1,16 @@
 #!/usr/bin/python3
 
-import nn
+import os
+import sys
+import queue
+import traceback
+import multiprocessing
+import helpers
+import metrics
+import section_cache
 import generator as gen
 import parse_midi as pm
+from concurrent.futures import ThreadPoolExecutor
 
 
 class SongCreator:
@@ -11,19 +19,26 @@ class SongCreator:
     This allows for the training, generating of songs, and saving and
     loading of models.
 
-    Three RNNs and three NoteManagers are created upon each instance
-    of SongCreator:
+    Three RNNs and three NoteManagers belong to each instance
+    of SongCreator, each built the first time it is used:
 
     functions:
     -train
+    -train_parallel
+    -update
     -parse
     -load_nn
     -load_nn_weights
     -save_model
+    -export_tflite
+    -use_tflite
     -create_song
+    -create_songs
+    -generate_songs
     """
 
-    def __init__(self, genre, instrument, parsed=False, epochs=100, batch_size=32):
+    def __init__(self, genre, instrument, parsed=False, epochs=100, batch_size=32, architecture="multi_hot",
+                 cache_size=256, managers=None):
         """
         genre: a string representing the intended genre of music
         instrument: a string representing the instrument this
@@ -32,6 +47,14 @@ class SongCreator:
         in genre/instrument/parsed_notes
         epochs: an int, number of epochs to run during training.
         batch_size: an int, the batch size used for training the networks.
+        architecture: "multi_hot" or "embedding", the input representation
+        of networks built for training (see MusicRNN). Loaded bundles
+        keep the architecture they were saved with.
+        cache_size: an int, the most generated sections kept in
+        genre/instrument/nn_cache (see generate_songs), 0 to not cache them
+        managers: an optional dict of section --> NotesManager to use
+        instead of loading the notes in genre/instrument/parsed_notes,
+        e.g. notes parsed somewhere else
         """
 
         # set genre, instrument, and path
@@ -43,81 +66,380 @@ class SongCreator:
         if not parsed:
             self.parse()
 
-        # create NoteManager objects
-        self.introManager = pm.NotesManager("{}/parsed_notes/intro.pickle".format(self.path))
-        self.middleManager = pm.NotesManager("{}/parsed_notes/middle.pickle".format(self.path))
-        self.outroManager = pm.NotesManager("{}/parsed_notes/outro.pickle".format(self.path))
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.architecture = architecture
+        self.cache = section_cache.SectionCache("{}/nn_cache".format(self.path), cache_size) if cache_size else None
 
-        # grab the training inputs and outputs
-        self.intro_training_input, self.intro_training_output = self.introManager.create_sequences()
-        self.middle_training_input, self.middle_training_output = self.middleManager.create_sequences()
-        self.outro_training_input, self.outro_training_output = self.outroManager.create_sequences()
+        # the NotesManagers, their training data, and the RNNs are only
+        # built when a command first needs them
+        self._managers = dict(managers or {})
+        self._rnns = {}
 
-        # create recurrent neural networks
-        self.introRNN = nn.MusicRNN(self.introManager, epochs=epochs, batch_size=batch_size)
-        self.middleRNN = nn.MusicRNN(self.middleManager, epochs=epochs, batch_size=batch_size)
-        self.outroRNN = nn.MusicRNN(self.outroManager, epochs=epochs, batch_size=batch_size)
+    def manager(self, section):
+        """
+        Returns the NotesManager of the given section, loading
+        its notes the first time it is asked for.
+
+        section: "intro", "middle", or "outro"
+        """
+        if section not in self._managers:
+            self._managers[section] = pm.NotesManager(self.notes_file(section))
+        return self._managers[section]
+
+    def rnn(self, section):
+        """
+        Returns the MusicRNN of the given section, building it
+        the first time it is asked for. keras and tensorflow
+        are only imported then.
+
+        section: "intro", "middle", or "outro"
+        """
+        if section not in self._rnns:
+            import nn
+            self._rnns[section] = nn.MusicRNN(self.manager(section), epochs=self.epochs,
+                                              batch_size=self.batch_size, architecture=self.architecture)
+        return self._rnns[section]
+
+    @property
+    def introManager(self):
+        return self.manager("intro")
+
+    @property
+    def middleManager(self):
+        return self.manager("middle")
+
+    @property
+    def outroManager(self):
+        return self.manager("outro")
+
+    @property
+    def intro_training_input(self):
+        return self.introRNN.training_data()[0]
+
+    @property
+    def intro_training_output(self):
+        return self.introRNN.training_data()[1]
 
-    def parse(self):
+    @property
+    def middle_training_input(self):
+        return self.middleRNN.training_data()[0]
+
+    @property
+    def middle_training_output(self):
+        return self.middleRNN.training_data()[1]
+
+    @property
+    def outro_training_input(self):
+        return self.outroRNN.training_data()[0]
+
+    @property
+    def outro_training_output(self):
+        return self.outroRNN.training_data()[1]
+
+    @property
+    def introRNN(self):
+        return self.rnn("intro")
+
+    @property
+    def middleRNN(self):
+        return self.rnn("middle")
+
+    @property
+    def outroRNN(self):
+        return self.rnn("outro")
+
+    def parse(self, backend="music21"):
         """
         Parses the songs in the genre/instrument/training_songs folder and extracts
         the notes to the genre/instrument/parsed_notes folder.
+        Songs are parsed in parallel, and songs that haven't changed
+        since the last parse are taken from the notes cache.
+
+        backend: "music21" or "mido", the MIDI parser to use
         """
         pm.parse_notes("{}/training_songs/*.mid".format(self.path),
-                       "{}/parsed_notes".format(self.path))
+                       "{}/parsed_notes".format(self.path), workers=os.cpu_count() or 1,
+                       backend=backend)
+
+    def notes_file(self, section):
+        """
+        Returns the parsed notes file of the given section, the
+        note corpus if there is one, otherwise the pickle.
+
+        section: "intro", "middle", or "outro"
+        """
+        corpus = "{}/parsed_notes/{}.corpus".format(self.path, section)
+        if os.path.exists(corpus):
+            return corpus
+        return "{}/parsed_notes/{}.pickle".format(self.path, section)
+
+    def bundle_path(self, section):
+        """
+        Returns the folder of the given section's model bundle,
+        genre/instrument/nn_models/<section>.bundle
+
+        section: "intro", "middle", or "outro"
+        """
+        return "{}/nn_models/{}.bundle".format(self.path, section)
+
+    def __load_bundle__(self, section):
+        """
+        Loads the given section's model bundle, if it has one,
+        as its MusicRNN and NotesManager. Returns True if it did.
+        """
+        if not os.path.isdir(self.bundle_path(section)):
+            return False
+
+        import nn
+
+        self._rnns[section] = nn.MusicRNN.load_bundle(self.bundle_path(section), epochs=self.epochs,
+                                                      batch_size=self.batch_size)
+        self._managers[section] = self._rnns[section].notes_manager
+        return True
 
     def load_nn(self):
         """
         Loads previously saved neural networks from the
-        nn_models folder.
+        nn_models folder. Model bundles are loaded without
+        reading the parsed notes; older saved models are
+        loaded onto networks built from the parsed notes.
         """
-        self.introRNN.load("{}/nn_models/nn_intro".format(self.path))
-        self.middleRNN.load("{}/nn_models/nn_middle".format(self.path))
-        self.outroRNN.load("{}/nn_models/nn_outro".format(self.path))
+        for section in ("intro", "middle", "outro"):
+            if not self.__load_bundle__(section):
+                self.rnn(section).load("{}/nn_models/nn_{}".format(self.path, section))
 
     def load_nn_weights(self):
         """
         Loads previously saved neural network weights from
-        the nn_weights folder.
+        the nn_weights folder. If a section has a model
+        bundle, the weights are loaded onto the bundled model.
         """
-        self.introRNN.load_weights("{}/nn_weights/intro.weights.best.hdf5".format(self.path))
-        self.middleRNN.load_weights("{}/nn_weights/middle.weights.best.hdf5".format(self.path))
-        self.middleRNN.load_weights("{}/nn_weights/middle.weights.best.hdf5".format(self.path))
+        for section in ("intro", "middle", "outro"):
+            self.__load_bundle__(section)
+            self.rnn(section).load_weights("{}/nn_weights/{}.weights.best.hdf5".format(self.path, section))
 
-    def train(self, save_weights=True):
+    def train(self, save_weights=True, streaming=False, key_shift=0, patience=None, resume=False, dedup=False):
         """
         Trains the neural networks. Saves
         weights by default to genre/instrument/nn_weights
         as '().weights.best.hdf5'
 
         save_weights: A boolean
+        streaming: A boolean, set to True to encode the training
+        batches on the fly instead of training on the full windows
+        key_shift: An integer, if > 0 the training windows are
+        shifted by up to key_shift semitones as batches are built.
+        This implies streaming.
+        patience: An integer, if given each network stops training once
+        its validation loss hasn't improved for this many epochs
+        resume: A boolean, set to True to carry on an interrupted run
+        from its last saved epoch. Needs save_weights.
+        dedup: A boolean, set to True to train on each distinct (window,
+        next note) example once, weighted by how often it occurs, so
+        repeated choruses and riffs don't make epochs longer (see
+        MusicRNN.training_data)
         """
+        options = {"patience": patience, "resume": resume}
 
         # trains and save the neural networks
-        if save_weights:
+        if streaming or key_shift:
+            workers = os.cpu_count() or 1
+            options["dedup"] = dedup
+            if save_weights:
+                self.introRNN.train_streaming(filename="{}/nn_weights/intro".format(self.path), workers=workers,
+                                              max_shift=key_shift, **options)
+                self.middleRNN.train_streaming(filename="{}/nn_weights/middle".format(self.path), workers=workers,
+                                               max_shift=key_shift, **options)
+                self.outroRNN.train_streaming(filename="{}/nn_weights/outro".format(self.path), workers=workers,
+                                              max_shift=key_shift, **options)
+            else:
+                self.introRNN.train_streaming(workers=workers, max_shift=key_shift, **options)
+                self.middleRNN.train_streaming(workers=workers, max_shift=key_shift, **options)
+                self.outroRNN.train_streaming(workers=workers, max_shift=key_shift, **options)
+        elif dedup:
+            for section in ("intro", "middle", "outro"):
+                training_input, training_output, sample_weight, validation_data = self.rnn(section).training_data(
+                    dedup=True)
+                filename = "{}/nn_weights/{}".format(self.path, section) if save_weights else None
+                self.rnn(section).train(training_input, training_output, filename=filename,
+                                        sample_weight=sample_weight, validation_data=validation_data, **options)
+        elif save_weights:
             self.introRNN.train(self.intro_training_input, self.intro_training_output,
-                                filename="{}/nn_weights/intro".format(self.path))
+                                filename="{}/nn_weights/intro".format(self.path), **options)
             self.middleRNN.train(self.middle_training_input, self.middle_training_output,
-                                 filename="{}/nn_weights/middle".format(self.path))
+                                 filename="{}/nn_weights/middle".format(self.path), **options)
             self.outroRNN.train(self.outro_training_input, self.outro_training_output,
-                                filename="{}/nn_weights/outro".format(self.path))
+                                filename="{}/nn_weights/outro".format(self.path), **options)
         # train without saving
         else:
-            self.introRNN.train(self.intro_training_input, self.intro_training_output)
-            self.middleRNN.train(self.middle_training_input, self.middle_training_output)
-            self.outroRNN.train(self.outro_training_input, self.outro_training_output)
+            self.introRNN.train(self.intro_training_input, self.intro_training_output, **options)
+            self.middleRNN.train(self.middle_training_input, self.middle_training_output, **options)
+            self.outroRNN.train(self.outro_training_input, self.outro_training_output, **options)
+
+    def update(self, files, replay=.25, epochs=None, patience=None, save_weights=True, backend="music21"):
+        """
+        Adds new songs to the corpus and fine tunes the networks on
+        them instead of training from scratch. The new songs are parsed
+        and appended to the parsed notes, the networks are grown to the
+        new vocabulary keeping what they learned (see MusicRNN.remap),
+        then trained on the new windows and a replay sample of the old.
+        The networks have to be loaded or trained first.
+
+        files: a list of the MIDI files of the new songs, which should
+        also be added to genre/instrument/training_songs
+        replay: a float, see MusicRNN.fine_tune
+        epochs: An integer, the number of epochs to fine tune for
+        patience: as in train
+        save_weights: A boolean, saves the weights to
+        genre/instrument/nn_weights as train does
+        backend: "music21" or "mido", the MIDI parser to use
+        """
+        sections = ("intro", "middle", "outro")
+
+        # the current networks, with the vocabularies they were trained on
+        rnns = {section: self.rnn(section) for section in sections}
+
+        new_from = pm.append_notes(files, "{}/parsed_notes".format(self.path), workers=os.cpu_count() or 1,
+                                   backend=backend)
+
+        for section in sections:
+            self._managers[section] = pm.NotesManager(self.notes_file(section))
+            self._rnns[section] = rnns[section].remap(self._managers[section])
+
+            filename = "{}/nn_weights/{}".format(self.path, section) if save_weights else None
+            self._rnns[section].fine_tune(new_from[section], replay=replay, epochs=epochs, filename=filename,
+                                          patience=patience, workers=os.cpu_count() or 1)
+
+    def train_parallel(self, streaming=False, key_shift=0, intra_threads=None, inter_threads=1, progress=None,
+                       patience=None, resume=False, dedup=False):
+        """
+        Trains the intro, middle, and outro networks at the same time,
+        each in its own process, so training takes about as long as
+        the middle network alone. The best weights are saved to
+        genre/instrument/nn_weights as in train, then loaded into
+        this SongCreator's networks.
+
+        streaming, key_shift, patience, resume, dedup: as in train
+        intra_threads: An integer, threads each process's operations
+        may use, by default the CPU count split between the three
+        inter_threads: An integer, operations each process may run at once
+        progress: a function called with a dict of section --> (epoch,
+        logs) every time a section finishes an epoch, by default one
+        line of every section's progress is printed
+        """
+        sections = ("intro", "middle", "outro")
+        intra_threads = intra_threads or max(1, (os.cpu_count() or 1) // len(sections))
+        progress = progress or self.__print_progress__
+
+        # spawned processes don't inherit this process's tensorflow state
+        context = multiprocessing.get_context("spawn")
+        messages = context.Queue()
+        workers = {section: context.Process(target=__train_section__,
+                                            args=(self.genre, self.instrument, section, self.epochs,
+                                                  self.batch_size, self.architecture, streaming, key_shift, patience,
+                                                  resume, dedup, intra_threads, inter_threads, messages))
+                   for section in sections}
+
+        for worker in workers.values():
+            worker.start()
+
+        state = {section: (0, {}) for section in sections}
+        running = set(sections)
+        errors = {}
+        exited = set()
+
+        while running:
+            try:
+                message = messages.get(timeout=1)
+            except queue.Empty:
+
+                # a process that was killed can't report its own error. Its last
+                # messages may still be on their way, so wait one more timeout
+                for section in list(running):
+                    if section in exited:
+                        running.discard(section)
+                        errors[section] = "exited with code {}".format(workers[section].exitcode)
+                    elif not workers[section].is_alive():
+                        exited.add(section)
+                continue
+
+            if message[0] == "epoch":
+                _, section, epoch, logs = message
+                state[section] = (epoch, logs)
+                progress(state)
+            elif message[0] == "done":
+                running.discard(message[1])
+            elif message[0] == "error":
+                running.discard(message[1])
+                errors[message[1]] = message[2]
+
+        for worker in workers.values():
+            worker.join()
+        print()
+
+        if errors:
+            raise RuntimeError("training failed:\n" + "\n".join(
+                "{}: {}".format(section, error) for section, error in errors.items()))
+
+        for section in sections:
+            self.rnn(section).load_weights("{}/nn_weights/{}.weights.best.hdf5".format(self.path, section))
+
+    def __print_progress__(self, state):
+        """
+        Prints every section's latest epoch and loss on one line
+        """
+        parts = []
+        for section, (epoch, logs) in state.items():
+            loss = " loss {:.4f}".format(logs["loss"]) if "loss" in logs else ""
+            parts.append("{} {}/{}{}".format(section, epoch, self.epochs, loss))
+
+        sys.stdout.write("\r" + " | ".join(parts))
+        sys.stdout.flush()
 
     def save_model(self):
         """
-        Saves the models of the neural networks
-        to genre/instrument/nn_models
+        Saves the models of the neural networks as model
+        bundles to genre/instrument/nn_models
+        """
+        self.introRNN.save_bundle(self.bundle_path("intro"))
+        self.middleRNN.save_bundle(self.bundle_path("middle"))
+        self.outroRNN.save_bundle(self.bundle_path("outro"))
+
+    def tflite_path(self, section):
+        """
+        Returns the file of the given section's TFLite model,
+        genre/instrument/nn_models/<section>.tflite
+
+        section: "intro", "middle", or "outro"
+        """
+        return "{}/nn_models/{}.tflite".format(self.path, section)
+
+    def export_tflite(self, quantization=None):
+        """
+        Exports the networks as TFLite models to genre/instrument/nn_models
+        and compares their predictions against the networks'.
+
+        quantization: None, "float16", or "int8", see MusicRNN.export_tflite
+        returns: a dict of section --> agreement, see MusicRNN.prediction_agreement
+        """
+        agreement = {}
+        for section in ("intro", "middle", "outro"):
+            self.rnn(section).export_tflite(self.tflite_path(section), quantization=quantization)
+            agreement[section] = self.rnn(section).prediction_agreement(self.tflite_path(section))
+        return agreement
+
+    def use_tflite(self):
+        """
+        Generates songs with the TFLite models saved by export_tflite
+        instead of the networks
         """
-        self.introRNN.save("{}/nn_models/nn_intro".format(self.path))
-        self.middleRNN.save("{}/nn_models/nn_middle".format(self.path))
-        self.outroRNN.save("{}/nn_models/nn_outro".format(self.path))
+        for section in ("intro", "middle", "outro"):
+            self.rnn(section).use_tflite(self.tflite_path(section))
 
     def create_song(self, song_name, intro_len=32, verse_len=52, chorus_len=64,
-                    bridge_len=48, outro_len=32):
+                    bridge_len=48, outro_len=32, backend="music21", folder=None, temperature=None, top_k=None,
+                    seed=None):
         """
         Generates notes from the intro, middle, and outro
         RNNs, combining them to create a single song. It
@@ -132,16 +454,121 @@ class SongCreator:
         chorus_len: An integer, the length of the chorus of the song
         bridge_len: An integer, the length of the bridge of the song
         outro_len: An integer, length of the outro of the song
+        backend: "music21" or "mido", the MIDI writer to use
+        folder: A string, the folder to save the song in instead
+        of genre/instrument/nn_songs
+        temperature, top_k: sample the notes instead of taking the
+        most likely ones, see nn.sample_codes
+        seed: An integer, makes the song reproducible: the same seed
+        always gives the same sections, which are then read from the
+        cache instead of generated again, even when the lengths change
+        """
+
+        self.create_songs([song_name], intro_len=intro_len, verse_len=verse_len, chorus_len=chorus_len,
+                          bridge_len=bridge_len, outro_len=outro_len, backend=backend, folder=folder,
+                          temperature=temperature, top_k=top_k, seed=None if seed is None else [seed])
+
+    def create_songs(self, song_names, intro_len=32, verse_len=52, chorus_len=64,
+                     bridge_len=48, outro_len=32, backend="music21", folder=None, temperature=None, top_k=None,
+                     seed=None):
         """
+        Generates one song per name with generate_songs and writes
+        them under genre/instrument/nn_songs once they have all
+        been generated.
 
-        intro_notes = gen.generate_notes(self.introRNN, intro_len)
-        verse1_notes = gen.generate_notes(self.middleRNN, verse_len)
-        chorus_notes = gen.generate_notes(self.middleRNN, chorus_len)
-        verse2_notes = gen.generate_notes(self.middleRNN, verse_len)
-        bridge_notes = gen.generate_notes(self.middleRNN, bridge_len)
-        outro_notes = gen.generate_notes(self.outroRNN, outro_len)
+        song_names: A list of strings, names of the files to save the songs as
+        the remaining arguments are as in create_song
+        """
+
+        folder = folder or "{}/nn_songs".format(self.path)
+        songs = self.generate_songs(len(song_names), intro_len=intro_len, verse_len=verse_len,
+                                    chorus_len=chorus_len, bridge_len=bridge_len, outro_len=outro_len,
+                                    temperature=temperature, top_k=top_k, seed=seed)
+
+        for song_name, song_combined in zip(song_names, songs):
+            gen.write_to_midi(song_combined, "{}/{}".format(folder, song_name), backend=backend)
+
+    def generate_songs(self, num_songs, intro_len=32, verse_len=52, chorus_len=64,
+                       bridge_len=48, outro_len=32, temperature=None, top_k=None, seed=None):
+        """
+        Generates the notes of num_songs songs in a single batched
+        pass: each section is generated for every song at once, so
+        each step is one forward pass over all the songs. The four
+        middle sections of every song are batched together through
+        the middle RNN, while the intro and outro are generated in
+        parallel with them.
+
+        Every section of a song is generated from its own part of the
+        song's seed (see generator.split_seed), and sections of seeded
+        songs are cached under genre/instrument/nn_cache.
+
+        num_songs: An integer, the number of songs to generate
+        seed: An integer split between the songs, or a list of num_songs
+        seeds, one per song (None for a random song)
+        the remaining arguments are as in create_song
+        returns: a list of num_songs lists of (pitch, duration) tuples
+        """
+
+        middle_lens = [verse_len, chorus_len, verse_len, bridge_len]
+        sampling = {"temperature": temperature, "top_k": top_k, "cache": self.cache}
+
+        # the intro, four middle sections, and outro of each song
+        section_seeds = [gen.split_seed(song_seed, 6) for song_seed in gen.split_seed(seed, num_songs)]
+
+        # the intro, middle, and outro RNNs share nothing, so run them side by side
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            intro_future = executor.submit(metrics.timed("generate_intro")(gen.generate_notes_batch),
+                                           self.introRNN, intro_len, num_songs,
+                                           seed=[seeds[0] for seeds in section_seeds], **sampling)
+            middle_future = executor.submit(metrics.timed("generate_middle")(gen.generate_notes_batch),
+                                            self.middleRNN, max(middle_lens), len(middle_lens) * num_songs,
+                                            seed=[part for seeds in section_seeds for part in seeds[1:5]], **sampling)
+            outro_future = executor.submit(metrics.timed("generate_outro")(gen.generate_notes_batch),
+                                           self.outroRNN, outro_len, num_songs,
+                                           seed=[seeds[5] for seeds in section_seeds], **sampling)
+
+        intro_notes = intro_future.result()
+        middle_notes = middle_future.result()
+        outro_notes = outro_future.result()
+
+        songs = []
+        for i in range(num_songs):
+
+            # each middle section is the start of its own sequence, cut to the section's length
+            verse1_notes, chorus_notes, verse2_notes, bridge_notes = (
+                notes[:length] for notes, length in zip(middle_notes[4 * i:4 * i + 4], middle_lens))
+
+            songs.append(intro_notes[i] + verse1_notes + chorus_notes + verse2_notes +
+                         chorus_notes + bridge_notes + chorus_notes + outro_notes[i])
+
+        return songs
+
+
+def __train_section__(genre, instrument, section, epochs, batch_size, architecture, streaming, key_shift, patience,
+                      resume, dedup, intra_threads, inter_threads, messages):
+    """
+    Trains one section's network in a worker process of
+    SongCreator.train_parallel, reporting its progress on messages
+    """
+    try:
+        helpers.limit_threads(intra_threads, inter_threads)
+
+        import nn
+
+        song_creator = SongCreator(genre, instrument, parsed=True, epochs=epochs, batch_size=batch_size,
+                                   architecture=architecture)
+        rnn = song_creator.rnn(section)
+        filename = "{}/nn_weights/{}".format(song_creator.path, section)
+        options = {"callbacks": [nn.QueueProgress(messages, section)], "patience": patience, "resume": resume}
+
+        if streaming or key_shift:
+            rnn.train_streaming(filename=filename, workers=intra_threads, max_shift=key_shift, dedup=dedup, **options)
+        else:
+            training_input, training_output, sample_weight, validation_data = rnn.training_data(dedup=dedup)
+            rnn.train(training_input, training_output, filename=filename, sample_weight=sample_weight,
+                      validation_data=validation_data, **options)
 
-        song_combined = (intro_notes + verse1_notes + chorus_notes + verse2_notes +
-                         chorus_notes + bridge_notes + chorus_notes + outro_notes)
+        messages.put(("done", section))
 
-        gen.write_to_midi(song_combined, "{}/nn_songs/{}".format(self.path, song_name))
+    except Exception:
+        messages.put(("error", section, traceback.format_exc()))
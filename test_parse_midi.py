@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+"""
+tests of the note parsing and training window code in parse_midi.
+Run with python3 -m unittest test_parse_midi (or pytest) from the
+repository folder. The mido/music21 comparison is skipped if music21
+isn't installed, and the one_hot_encoder comparison if sklearn isn't.
+"""
+
+import os
+import io
+import glob
+import pickle
+import shutil
+import tempfile
+import unittest
+import contextlib
+import importlib.util
+import numpy
+import parse_midi
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# a few notes, chords and rests, where "62" and "62,66" are "60" and "60,64" shifted up two semitones
+NOTES = [["60", "-1.0"], ["62", "-0.5"], ["60,64", "-1.0"], ["62,66", "-0.5"], ["X", "-1.0"],
+         ["60", "-1.0"], ["62", "-0.5"], ["60,64", "-1.0"], ["62,66", "-0.5"], ["X", "-1.0"],
+         ["60", "-1.0"], ["62", "-0.5"], ["60,64", "-1.0"], ["65", "-2.0"], ["X", "-1/3"]]
+
+
+def has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+class NotesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_pickle(self, notes, name="notes.pickle"):
+        """
+        pickles notes the way parse_notes used to, returns the file path
+        """
+        file = os.path.join(self.folder, name)
+        with open(file, "wb") as fp:
+            pickle.dump(notes, fp)
+
+        return file
+
+    def manager(self, notes, sequence_len=4):
+        return parse_midi.NotesManager(self.write_pickle(notes), sequence_len=sequence_len)
+
+
+class TestCorpus(NotesTestCase):
+
+    def test_round_trip(self):
+        file = os.path.join(self.folder, "notes.corpus")
+        parse_midi.write_corpus(NOTES, file)
+        pitch_vocab, length_vocab, codes = parse_midi.load_corpus(file)
+
+        self.assertIsInstance(codes, numpy.memmap)
+        self.assertEqual(codes.shape, (len(NOTES), 2))
+        self.assertEqual([[pitch_vocab[p], length_vocab[l]] for p, l in codes.tolist()], NOTES)
+
+    def test_empty(self):
+        file = os.path.join(self.folder, "notes.corpus")
+        parse_midi.write_corpus([], file)
+        pitch_vocab, length_vocab, codes = parse_midi.load_corpus(file)
+
+        self.assertEqual((pitch_vocab, length_vocab), ([], []))
+        self.assertEqual(codes.shape, (0, 2))
+
+    def test_not_a_corpus(self):
+        file = self.write_pickle(NOTES)
+        with self.assertRaises(ValueError):
+            parse_midi.load_corpus(file)
+
+    def test_keep_vocab(self):
+        file = os.path.join(self.folder, "notes.corpus")
+        parse_midi.write_corpus(NOTES, file)
+        old_pitches, old_lengths, _ = parse_midi.load_corpus(file)
+
+        notes = [["59", "-4.0"], ["60", "-1.0"]]
+        parse_midi.write_corpus(notes, file, keep_vocab=True)
+        pitch_vocab, length_vocab, codes = parse_midi.load_corpus(file)
+
+        # the old classes keep their codes and the new ones come after them
+        self.assertEqual(pitch_vocab, old_pitches + ["59"])
+        self.assertEqual(length_vocab, old_lengths + ["-4.0"])
+        self.assertEqual([[pitch_vocab[p], length_vocab[l]] for p, l in codes.tolist()], notes)
+
+    def test_append(self):
+        file = os.path.join(self.folder, "notes.corpus")
+        parse_midi.write_corpus(NOTES[:5], file)
+        _, _, old_codes = parse_midi.load_corpus(file)
+        old_codes = numpy.array(old_codes)
+
+        self.assertEqual(parse_midi.append_corpus(NOTES[5:], file), 5)
+        pitch_vocab, length_vocab, codes = parse_midi.load_corpus(file)
+
+        numpy.testing.assert_array_equal(codes[:5], old_codes)
+        self.assertEqual([[pitch_vocab[p], length_vocab[l]] for p, l in codes.tolist()], NOTES)
+
+    def test_append_seeds_from_pickle(self):
+        self.write_pickle(NOTES[:5])
+        file = os.path.join(self.folder, "notes.corpus")
+
+        self.assertEqual(parse_midi.append_corpus(NOTES[5:], file), 5)
+        pitch_vocab, length_vocab, codes = parse_midi.load_corpus(file)
+
+        self.assertEqual([[pitch_vocab[p], length_vocab[l]] for p, l in codes.tolist()], NOTES)
+
+    def test_manager_reads_either_format(self):
+        file = os.path.join(self.folder, "notes.corpus")
+        parse_midi.write_corpus(NOTES, file)
+
+        from_pickle = self.manager(NOTES)
+        from_corpus = parse_midi.NotesManager(file, sequence_len=4)
+
+        numpy.testing.assert_array_equal(from_corpus.note_codes, from_pickle.note_codes)
+        self.assertEqual(from_corpus.decode(from_corpus.note_codes),
+                         [(pitch, length[1:]) for pitch, length in NOTES])
+
+
+class TestWindows(NotesTestCase):
+
+    @unittest.skipUnless(has_module("sklearn"), "sklearn is not installed")
+    def test_create_sequences_matches_binarizer(self):
+        from sklearn.preprocessing import MultiLabelBinarizer
+
+        for notes, sequence_len in ((NOTES, 4), (self.bundled_notes(), 16)):
+            manager = self.manager(notes, sequence_len)
+            training_input, training_output = manager.create_sequences()
+
+            # the windows as they were built before, one copy per window
+            encoded = MultiLabelBinarizer().fit_transform(notes)
+            expected_input = numpy.asarray([encoded[i:i + sequence_len] for i in range(len(encoded) - sequence_len)])
+            expected_output = encoded[sequence_len:]
+
+            numpy.testing.assert_array_equal(training_input, expected_input)
+            numpy.testing.assert_array_equal(training_output, expected_output)
+
+            # and the windows encoded on demand are the same
+            starts = numpy.arange(len(training_input))
+            window_input, window_output = manager.encode_windows(starts)
+            numpy.testing.assert_array_equal(window_input, expected_input)
+            numpy.testing.assert_array_equal(window_output, expected_output)
+
+    def test_code_sequences(self):
+        manager = self.manager(NOTES)
+        training_input, training_output = manager.create_code_sequences()
+        [pitches, lengths], [next_pitches, next_lengths] = manager.code_windows(numpy.arange(len(training_input)))
+
+        numpy.testing.assert_array_equal(training_input[..., 0], pitches)
+        numpy.testing.assert_array_equal(training_input[..., 1], lengths)
+        numpy.testing.assert_array_equal(training_output, numpy.stack([next_pitches, next_lengths], axis=1))
+
+    def test_unique_windows(self):
+        for notes, sequence_len in ((NOTES, 4), (NOTES, 2), (self.bundled_notes(), 16)):
+            manager = self.manager(notes, sequence_len)
+            starts, counts = manager.unique_windows()
+
+            # count the examples, each window and the note after it, one by one
+            expected = {}
+            for i in range(len(notes) - sequence_len):
+                example = tuple(map(tuple, notes[i:i + sequence_len + 1]))
+                first, count = expected.get(example, (i, 0))
+                expected[example] = (first, count + 1)
+
+            self.assertEqual(list(zip(starts.tolist(), counts.tolist())), sorted(expected.values()))
+            self.assertEqual(counts.sum(), len(notes) - sequence_len)
+
+    def test_unique_windows_of_starts(self):
+        manager = self.manager(NOTES)
+
+        # windows 0 and 5 hold the same example, 1 only appears once here
+        starts, counts = manager.unique_windows([5, 1, 0])
+        self.assertEqual(starts.tolist(), [5, 1])
+        self.assertEqual(counts.tolist(), [2, 1])
+
+    def test_shift_table(self):
+        manager = self.manager(NOTES)
+        code = {pitch: i for i, pitch in enumerate(manager.pitch_vocab)}
+        table = manager.shift_table(2)
+
+        self.assertEqual(table.shape, (5, manager.num_pitches))
+        self.assertIs(manager.shift_table(2), table)
+
+        # no shift maps every pitch to itself
+        numpy.testing.assert_array_equal(table[2], numpy.arange(manager.num_pitches))
+
+        self.assertEqual(table[2 + 2, code["60"]], code["62"])
+        self.assertEqual(table[2 - 2, code["62"]], code["60"])
+        self.assertEqual(table[2 + 2, code["60,64"]], code["62,66"])
+        self.assertEqual(table[2 + 2, code["62"]], -1)
+        self.assertEqual(table[2 + 1, code["60"]], -1)
+        self.assertTrue((table[:, code["X"]] == code["X"]).all())
+
+    def test_shifted_windows(self):
+        manager = self.manager([["60", "-1.0"], ["X", "-1.0"], ["62", "-1.0"], ["64", "-1.0"], ["60", "-1.0"]], 2)
+        code = {pitch: i for i, pitch in enumerate(manager.pitch_vocab)}
+
+        # window 0 shifted up two semitones is still in the vocabulary, window 1 isn't, so it stays as it is
+        [pitches, _], [next_pitches, _] = manager.code_windows([0, 1], shifts=[2, 2])
+
+        self.assertEqual(pitches.tolist(), [[code["62"], code["X"]], [code["X"], code["62"]]])
+        self.assertEqual(next_pitches.tolist(), [code["64"], code["64"]])
+
+    def test_random_shifts_stay_in_vocab(self):
+        manager = self.manager(self.bundled_notes())
+        starts = numpy.arange(len(manager.note_codes) - manager.sequence_len)
+        shifts = manager.random_shifts(starts, 3)
+
+        self.assertTrue((numpy.abs(shifts) <= 3).all())
+
+        [pitches, _], [next_pitches, _] = manager.code_windows(starts, shifts)
+        table = manager.shift_table(3)
+        originals = manager.note_codes[starts[:, None] + numpy.arange(manager.sequence_len), 0]
+
+        numpy.testing.assert_array_equal(pitches, table[shifts[:, None] + 3, originals])
+        self.assertTrue((next_pitches >= 0).all())
+
+    @staticmethod
+    def bundled_notes():
+        with open(os.path.join(REPO, "johnnycash/guitar/parsed_notes/middle.pickle"), "rb") as fp:
+            return pickle.load(fp)
+
+
+@unittest.skipUnless(has_module("music21"), "music21 is not installed")
+class TestMidoParser(unittest.TestCase):
+
+    def test_matches_music21(self):
+        files = sorted(glob.glob(os.path.join(REPO, "*/*/training_songs/*.mid")))
+        self.assertTrue(files)
+
+        for file in files:
+            with self.subTest(file=os.path.relpath(file, REPO)):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    expected = parse_midi.parse_song(file)
+                    notes = parse_midi.parse_song_mido(file)
+
+                self.assertEqual(notes, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()